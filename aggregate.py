@@ -0,0 +1,128 @@
+# Online aggregation of logged samples.
+
+# Samples are rolled up per device into windows of a fixed length, aligned to the clock (a 60 second window starts at a
+# full minute). Every window only keeps the number of samples and the minimum, maximum and sum of each value, so the
+# memory needed doesn't depend on how many samples a window gets. A window is written when the first sample of the
+# next one arrives, when the sample of another device shows that it has ended, or when the output is flushed because
+# no samples arrived for a while.
+#
+# The energy counters only ever go up, the rolled-up record contains how much they went up during the window. A
+# counter that goes down was reset, then its new value counts as increase.
+
+import time
+
+aggregate_values = ["voltage", "current", "temperature"]
+energy_values = ["charge_energy", "discharge_energy"]
+
+aggregate_fields = ["address", "time", "interval", "samples", "device_address"] + ["%s_%s" % (value, kind) for value in aggregate_values for kind in ["min", "max", "mean"]] + energy_values
+
+class _Window:
+    __slots__ = ["address", "start", "interval", "count", "device_address", "minimum", "maximum", "sum", "energy", "last_energy"]
+
+    def __init__(self, address, start, interval, last_energy=None):
+        self.address = address
+        self.start = start
+        self.interval = interval
+        self.count = 0
+        self.device_address = None
+        self.minimum = [None] * len(aggregate_values)
+        self.maximum = [None] * len(aggregate_values)
+        self.sum = [0.0] * len(aggregate_values)
+        self.energy = [0] * len(energy_values)
+        # the counters at the end of the previous window, so no energy gets lost between two windows
+        self.last_energy = last_energy
+
+    def add(self, record):
+        self.count += 1
+        self.device_address = record["device_address"]
+        for i, name in enumerate(aggregate_values):
+            value = record[name]
+            if self.count == 1 or value < self.minimum[i]:
+                self.minimum[i] = value
+            if self.count == 1 or value > self.maximum[i]:
+                self.maximum[i] = value
+            self.sum[i] += value
+        energy = [record[name] for name in energy_values]
+        if self.last_energy != None:
+            for i, value in enumerate(energy):
+                increase = value - self.last_energy[i]
+                self.energy[i] += increase if increase >= 0 else value
+        self.last_energy = energy
+
+    def result(self):
+        record = {
+            "address":self.address,
+            "time":self.start,
+            "interval":self.interval,
+            "samples":self.count,
+            "device_address":self.device_address,
+        }
+        for i, name in enumerate(aggregate_values):
+            record[name + "_min"] = self.minimum[i]
+            record[name + "_max"] = self.maximum[i]
+            record[name + "_mean"] = round(self.sum[i] / self.count, 3)
+        for i, name in enumerate(energy_values):
+            record[name] = self.energy[i]
+        return record
+
+# Used like one of the sinks: records need an address and a time. Rolled-up records go to sink, the samples themselves
+# to raw if it's given.
+class Aggregator:
+    def __init__(self, intervals, sink, raw=None):
+        self.intervals = intervals
+        self.sink = sink
+        self.raw = raw
+        self.windows = {}
+        self.checked = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def write(self, record):
+        if self.raw != None:
+            self.raw.write(record)
+        address = record["address"]
+        now = record["time"]
+        for interval in self.intervals:
+            key = (address, interval)
+            start = now - now % interval
+            window = self.windows.get(key)
+            if window == None or window.start != start:
+                last_energy = None
+                if window != None:
+                    last_energy = window.last_energy
+                    if window.count > 0:
+                        self.sink.write(window.result())
+                window = _Window(address, start, interval, last_energy)
+                self.windows[key] = window
+            window.add(record)
+        # devices that stopped sending don't start a new window, so look for ended windows once in a while
+        if now - self.checked >= 1.0:
+            self.checked = now
+            self.write_ended(now)
+
+    # Writes the windows that ended before now. Their energy counters are kept for the next window of the device.
+    def write_ended(self, now):
+        for key, window in list(self.windows.items()):
+            if window.count > 0 and window.start + window.interval <= now:
+                self.sink.write(window.result())
+                self.windows[key] = _Window(window.address, window.start, window.interval, window.last_energy)
+
+    def flush(self):
+        self.write_ended(time.time())
+        self.sink.flush()
+        if self.raw != None:
+            self.raw.flush()
+
+    def close(self):
+        # the windows that are still open are written as they are
+        for window in self.windows.values():
+            if window.count > 0:
+                self.sink.write(window.result())
+        self.windows.clear()
+        self.sink.close()
+        if self.raw != None:
+            self.raw.close()
@@ -0,0 +1,258 @@
+# Host side alerts on the live sample stream.
+
+# Every sample is checked against a list of rules as soon as it's decoded, before it's queued for output. A rule is
+# raised once when its condition starts to hold and cleared once when it stops holding, with an optional hysteresis so
+# a value hovering around a threshold doesn't raise an alert for every sample. Rules are given as JSON or YAML list:
+#
+#   - {name: low voltage, field: voltage, below: 11.8, hysteresis: 0.2}
+#   - {name: temperature, field: temperature, below: 0, above: 45, hysteresis: 1}
+#   - {name: voltage drop, field: voltage, rate: -0.5, window: 10}
+#
+# below/above is a threshold (both together a window the value has to stay in), rate a change per second over the
+# last window seconds (negative for falling values). Without rules the alarm thresholds from the configuration of
+# each device are used.
+#
+# Alerts are handed to the sinks through bounded queues, a slow sink loses alerts instead of holding up the samples.
+
+import sys
+import json
+import asyncio
+from collections import deque
+
+class Threshold:
+    def __init__(self, name, field, above=None, below=None, hysteresis=0.0):
+        self.name = name
+        self.field = field
+        self.above = above
+        self.below = below
+        self.hysteresis = hysteresis
+        self.active = False
+
+    def describe(self):
+        return {"above":self.above, "below":self.below}
+
+    # Returns "raised" or "cleared" when the state changes, None otherwise.
+    def check(self, info):
+        value = info[self.field]
+        if not self.active:
+            if (self.above != None and value > self.above) or (self.below != None and value < self.below):
+                self.active = True
+                return "raised"
+        elif (self.above == None or value <= self.above - self.hysteresis) and (self.below == None or value >= self.below + self.hysteresis):
+            self.active = False
+            return "cleared"
+        return None
+
+class RateOfChange:
+    def __init__(self, name, field, rate, window=10.0, hysteresis=0.0):
+        self.name = name
+        self.field = field
+        self.rate = rate
+        self.window = window
+        self.hysteresis = hysteresis
+        self.samples = deque()
+        self.active = False
+
+    def describe(self):
+        return {"rate":self.rate, "window":self.window}
+
+    def check(self, info):
+        now = info["time"]
+        value = info[self.field]
+        samples = self.samples
+        samples.append((now, value))
+        while now - samples[0][0] > self.window:
+            samples.popleft()
+        elapsed = now - samples[0][0]
+        if elapsed <= 0:
+            return None
+        # positive if the value changes in the direction of the rule
+        change = (value - samples[0][1]) / elapsed
+        if self.rate < 0:
+            change = -change
+        limit = abs(self.rate)
+        if not self.active and change > limit:
+            self.active = True
+            return "raised"
+        elif self.active and change <= limit - self.hysteresis:
+            self.active = False
+            return "cleared"
+        return None
+
+def make_rule(spec):
+    spec = dict(spec)
+    name = spec.pop("name", None)
+    field = spec.pop("field")
+    if name == None:
+        name = field
+    if "rate" in spec:
+        return RateOfChange(name, field, float(spec["rate"]), float(spec.get("window", 10.0)), float(spec.get("hysteresis", 0.0)))
+    if "above" not in spec and "below" not in spec:
+        raise ValueError("rule %s needs above, below or rate" % name)
+    return Threshold(name, field, spec.get("above"), spec.get("below"), float(spec.get("hysteresis", 0.0)))
+
+# Rules from a JSON or YAML file (YAML requires PyYAML).
+def load_rules(filename):
+    with open(filename) as f:
+        if filename.endswith(".yaml") or filename.endswith(".yml"):
+            try:
+                import yaml
+            except ImportError:
+                raise RuntimeError("YAML rules require the PyYAML module")
+            specs = yaml.safe_load(f)
+        else:
+            specs = json.load(f)
+    # check them once, so mistakes show up before logging starts
+    for spec in specs:
+        make_rule(spec)
+    return specs
+
+device_hysteresis = 0.1
+
+# The alarms the device itself has, from its configuration (message 2). A threshold of 0 is off.
+def device_rules(config):
+    specs = []
+    for name, field, kind in [("low_voltage_alarm", "voltage", "below"), ("under_battery_voltage", "voltage", "below"), ("high_voltage_alarm", "voltage", "above"), ("over_current_alarm", "current", "above")]:
+        threshold = config.get(name)
+        if threshold != None and threshold > 0:
+            specs.append({"name":name, "field":field, kind:threshold, "hysteresis":device_hysteresis})
+    return specs
+
+class AlertSink:
+    def __init__(self, queue_size=100):
+        self.queue = asyncio.Queue(queue_size)
+        self.dropped = 0
+
+    def send(self, alert):
+        try:
+            self.queue.put_nowait(alert)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def run(self):
+        while True:
+            alert = await self.queue.get()
+            try:
+                await self.deliver(alert)
+            except Exception as e:
+                print ("alert sink %s failed: %s" % (type(self).__name__, e), file=sys.stderr)
+
+    async def deliver(self, alert):
+        raise NotImplementedError()
+
+class PrintSink(AlertSink):
+    async def deliver(self, alert):
+        print ("%s %s: %s %s (%s = %s)" % (alert["time"], alert["address"], alert["rule"], alert["state"], alert["field"], alert["value"]), file=sys.stderr)
+
+# Runs a shell command for every alert, with the alert as JSON on stdin and its fields in ALERT_* environment variables.
+class ExecSink(AlertSink):
+    def __init__(self, command, **kwargs):
+        super().__init__(**kwargs)
+        self.command = command
+
+    async def deliver(self, alert):
+        import os
+        env = dict(os.environ)
+        for key, value in alert.items():
+            env["ALERT_" + key.upper()] = str(value)
+        process = await asyncio.create_subprocess_shell(self.command, stdin=asyncio.subprocess.PIPE, env=env)
+        await process.communicate(json.dumps(alert).encode())
+
+# POSTs every alert as JSON.
+class WebhookSink(AlertSink):
+    def __init__(self, url, timeout=5.0, **kwargs):
+        super().__init__(**kwargs)
+        self.url = url
+        self.timeout = timeout
+
+    def post(self, alert):
+        import urllib.request
+        request = urllib.request.Request(self.url, json.dumps(alert).encode(), {"Content-Type":"application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+    async def deliver(self, alert):
+        await asyncio.get_running_loop().run_in_executor(None, self.post, alert)
+
+# SysLogHandler only reports a socket it can't connect to when it logs, with a traceback for every alert. Syslog
+# listens on a datagram or a stream socket, depending on the system.
+def _check_syslog_socket(address):
+    import socket
+    error = None
+    for kind in [socket.SOCK_DGRAM, socket.SOCK_STREAM]:
+        try:
+            with socket.socket(socket.AF_UNIX, kind) as connection:
+                connection.connect(address)
+            return
+        except OSError as e:
+            error = error or e
+    raise RuntimeError("can't send alerts to syslog at %s: %s" % (address, error.strerror or error))
+
+# Sends every alert to syslog, address is a Unix socket (like /dev/log) or host[:port] for UDP.
+class SyslogSink(AlertSink):
+    def __init__(self, address="/dev/log", **kwargs):
+        super().__init__(**kwargs)
+        import logging.handlers
+        if not address.startswith("/"):
+            host, _, port = address.partition(":")
+            address = (host, int(port) if port != "" else logging.handlers.SYSLOG_UDP_PORT)
+        else:
+            _check_syslog_socket(address)
+        self.logger = logging.getLogger("wls-mvaxxx.alerts")
+        self.logger.propagate = False
+        self.logger.addHandler(logging.handlers.SysLogHandler(address))
+
+    async def deliver(self, alert):
+        import logging
+        level = logging.WARNING if alert["state"] == "raised" else logging.INFO
+        self.logger.log(level, "wls-mvaxxx: %s", json.dumps(alert))
+
+class AlertEngine:
+    def __init__(self, specs=None, sinks=None):
+        # without rules the device's own thresholds are used, which are only known once its configuration was read
+        self.specs = specs
+        self.sinks = sinks if sinks != None and len(sinks) > 0 else [PrintSink()]
+        self.rules = {}
+        self.device_specs = {}
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(sink.run()) for sink in self.sinks]
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def set_config(self, address, config):
+        if self.specs != None:
+            return
+        specs = device_rules(config)
+        # keep the state of the rules unless the thresholds changed
+        if specs != self.device_specs.get(address):
+            self.device_specs[address] = specs
+            self.rules[address] = [make_rule(spec) for spec in specs]
+
+    def rules_for(self, address):
+        rules = self.rules.get(address)
+        if rules == None:
+            rules = [make_rule(spec) for spec in self.specs] if self.specs != None else []
+            self.rules[address] = rules
+        return rules
+
+    def check(self, info):
+        for rule in self.rules_for(info["address"]):
+            state = rule.check(info)
+            if state != None:
+                alert = {
+                    "address":info["address"],
+                    "time":info["time"],
+                    "rule":rule.name,
+                    "state":state,
+                    "field":rule.field,
+                    "value":info[rule.field],
+                }
+                alert.update(rule.describe())
+                for sink in self.sinks:
+                    sink.send(alert)
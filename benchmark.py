@@ -0,0 +1,243 @@
+# Benchmarks for the decoding code, without any Bluetooth.
+
+# Synthetic notification streams from the emulator are fed through the checksum, the streaming decoder and the
+# vectorized capture decoder. For every benchmark the frames and bytes per second, the peak memory allocated while
+# decoding and the latency percentiles per notification are reported. Results can be saved as a baseline and later
+# runs compared against it:
+#
+#   python benchmark.py --save baseline.json
+#   python benchmark.py --baseline baseline.json
+#
+# The streams are:
+#   clean       one message per notification
+#   fragmented  messages split into random chunks of 1-8 bytes, like the CH9141 bridge does
+#   noisy       line noise (including stray headers) between messages
+#   bad-crc     every tenth message has a wrong checksum
+
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import importlib.util
+import tracemalloc
+
+from protocol import calc_crc, FrameDecoder, unpack_info_record, unpack_config
+from emulator import Emulator
+
+stream_kinds = ["clean", "fragmented", "noisy", "bad-crc"]
+
+# A device pushing main display data at 5 messages per second, like the emulator does.
+DEVICE_RATE = 5
+
+def make_messages(count, seed=1):
+    rng = random.Random(seed)
+    emulator = Emulator(log=None)
+    messages = []
+    for i in range(count):
+        emulator.voltage = rng.randrange(100, 1500)
+        emulator.current = rng.randrange(0, 2000)
+        emulator.capacity = rng.randrange(0, 65535)
+        emulator.temperature = rng.randrange(0, 600)
+        if i % 50 == 0:
+            # now and then a configuration message
+            emulator.messages.append(2)
+        messages.append(emulator.next_frame())
+    return messages
+
+# Returns the notifications of a stream of the given kind.
+def make_stream(kind, count, seed=1):
+    rng = random.Random(seed)
+    messages = make_messages(count, seed)
+    if kind == "clean":
+        return messages
+    elif kind == "fragmented":
+        data = b"".join(messages)
+        chunks = []
+        offset = 0
+        while offset < len(data):
+            size = rng.randint(1, 8)
+            chunks.append(data[offset:offset+size])
+            offset += size
+        return chunks
+    elif kind == "noisy":
+        chunks = []
+        for message in messages:
+            noise = bytes([rng.randrange(256) for _ in range(rng.randint(0, 8))])
+            if rng.random() < 0.2:
+                # a header that doesn't start a message
+                noise += b"\xb5\x5b\x04\x01"
+            chunks.append(noise + message)
+        return chunks
+    elif kind == "bad-crc":
+        chunks = []
+        for i, message in enumerate(messages):
+            if i % 10 == 0:
+                message = message[:-1] + bytes([(message[-1] + 1) & 0xFF])
+            chunks.append(message)
+        return chunks
+    raise ValueError("unknown stream %s" % kind)
+
+def percentile(values, fraction):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+# The streaming path of the host: decode the frames of every notification and unpack them.
+def decode_stream(chunks):
+    decoder = FrameDecoder()
+    frames = 0
+    for chunk in chunks:
+        for frame in decoder.feed(chunk):
+            if frame.message_id == 1:
+                unpack_info_record(frame.data, None, None)
+            elif frame.message_id == 2:
+                unpack_config(frame.data)
+            frames += 1
+    return frames
+
+def decode_stream_latency(chunks):
+    decoder = FrameDecoder()
+    latencies = []
+    clock = time.perf_counter
+    for chunk in chunks:
+        start = clock()
+        for frame in decoder.feed(chunk):
+            if frame.message_id == 1:
+                unpack_info_record(frame.data, None, None)
+            elif frame.message_id == 2:
+                unpack_config(frame.data)
+        latencies.append(clock() - start)
+    return latencies
+
+def crc_messages(chunks):
+    for chunk in chunks:
+        calc_crc(chunk[:-1])
+    return len(chunks)
+
+def crc_latency(chunks):
+    latencies = []
+    clock = time.perf_counter
+    for chunk in chunks:
+        start = clock()
+        calc_crc(chunk[:-1])
+        latencies.append(clock() - start)
+    return latencies
+
+def decode_capture_data(data):
+    import capture
+    import numpy
+    array = numpy.frombuffer(data, numpy.uint8)
+    starts = capture.find_frames(array)
+    message_ids = array[starts + 3]
+    capture.unpack_info_records(capture._records(array, starts[message_ids == 1], capture.info_dtype))
+    capture.unpack_config_records(capture._records(array, starts[message_ids == 2], capture.config_dtype))
+    return len(starts)
+
+def benchmarks(count, kinds):
+    result = []
+    clean = make_stream("clean", count)
+    result.append(("crc", clean, crc_messages, crc_latency))
+    for kind in kinds:
+        chunks = make_stream(kind, count)
+        result.append(("decode-" + kind, chunks, decode_stream, decode_stream_latency))
+    if importlib.util.find_spec("numpy") == None:
+        print ("numpy not found, skipping the capture benchmarks", file=sys.stderr)
+        return result
+    for kind in kinds:
+        data = b"".join(make_stream(kind, count))
+        result.append(("capture-" + kind, [data], lambda chunks: decode_capture_data(chunks[0]), None))
+    return result
+
+def run_benchmark(run, latency, chunks, repeat):
+    size = sum([len(chunk) for chunk in chunks])
+    frames = run(chunks)
+    # best of several runs, the others are disturbed by something else
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(chunks)
+        elapsed = time.perf_counter() - start
+        if best == None or elapsed < best:
+            best = elapsed
+
+    tracemalloc.start()
+    run(chunks)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {
+        "frames":frames,
+        "bytes":size,
+        "frames_per_sec":frames / best,
+        "bytes_per_sec":size / best,
+        "peak_kib":peak / 1024,
+        "p50_us":None,
+        "p99_us":None,
+        "max_us":None,
+    }
+    if latency != None:
+        latencies = latency(chunks)
+        result["p50_us"] = percentile(latencies, 0.50) * 1e6
+        result["p99_us"] = percentile(latencies, 0.99) * 1e6
+        result["max_us"] = max(latencies) * 1e6
+    return result
+
+def format_us(value):
+    return "%8.1f" % value if value != None else "       -"
+
+def print_results(results, baseline, tolerance):
+    regressions = []
+    print ("%-20s %12s %10s %9s %8s %8s %8s %s" % ("benchmark", "frames/s", "MB/s", "peak KiB", "p50 us", "p99 us", "max us", "vs baseline" if baseline != None else ""))
+    for name, result in results.items():
+        line = "%-20s %12.0f %10.2f %9.1f %s %s %s" % (name, result["frames_per_sec"], result["bytes_per_sec"] / 1e6, result["peak_kib"], format_us(result["p50_us"]), format_us(result["p99_us"]), format_us(result["max_us"]))
+        if baseline != None and name in baseline:
+            change = result["frames_per_sec"] / baseline[name]["frames_per_sec"] - 1
+            line += " %+6.1f%%" % (change * 100)
+            if change < -tolerance:
+                line += " REGRESSION"
+                regressions.append(name)
+        print (line)
+    return regressions
+
+def print_capacity(results):
+    # the streaming decoder runs for every notification of every device, so it limits how many devices one core can
+    # keep up with
+    for kind in ["clean", "fragmented"]:
+        result = results.get("decode-" + kind)
+        if result != None:
+            print ("%s streams: about %i devices per core at %i messages per second" % (kind, result["frames_per_sec"] / DEVICE_RATE, DEVICE_RATE))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the WLS-MVAxxx decoding code")
+    parser.add_argument('--frames', type=int, default=20000, help='number of messages per stream')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timed runs, the fastest one counts')
+    parser.add_argument('--stream', choices=stream_kinds, action='append', help='only run the given stream kinds')
+    parser.add_argument('--save', help='save the results as baseline to this file')
+    parser.add_argument('--baseline', help='compare against the results saved in this file')
+    parser.add_argument('--tolerance', type=float, default=10, help='slowdown in percent that counts as regression')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline != None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    results = {}
+    for name, chunks, run, latency in benchmarks(args.frames, args.stream or stream_kinds):
+        results[name] = run_benchmark(run, latency, chunks, args.repeat)
+
+    regressions = print_results(results, baseline, args.tolerance / 100)
+    print_capacity(results)
+
+    if args.save != None:
+        with open(args.save, "w") as f:
+            json.dump({"python":platform.python_version(), "machine":platform.machine(), "time":time.time(), "frames":args.frames, "results":results}, f, indent=1)
+    if len(regressions) > 0:
+        print ("%i benchmarks slower than the baseline" % len(regressions), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+# Offline decoder for captured notification data, requires numpy.
+
+# A capture is either the raw bytes of the notifications or the hex dump printed by dump_message (or by the emulator),
+# one notification per line. Frames are found, checked and unpacked for the whole capture at once instead of frame by
+# frame.
+
+import os
+import numpy
+from protocol import DEVICE_MAGIC, message_size, info_message, config_message
+
+_hex_characters = set(b"0123456789abcdefABCDEF \t\r\n")
+
+_numpy_types = {"B":"u1", "H":">u2", "I":">u4"}
+
+# A numpy record type with the layout of a message, so a whole array of frames can be viewed as an array of records.
+# Numbers that are split into parts get one column per part: <name>_high and <name>_low.
+def message_dtype(codec):
+    fields = [("magic", ">u2"), ("device_address", "u1"), ("message_id", "u1")]
+    for name, format, scale, index, shifts in codec.fields:
+        if shifts == None:
+            fields.append((name, _numpy_types[format]))
+        else:
+            for part, suffix in zip(format, ["high", "low"]):
+                fields.append(("%s_%s" % (name, suffix), _numpy_types[part]))
+    if codec.checksum:
+        fields.append(("crc", "u1"))
+    return numpy.dtype(fields)
+
+info_dtype = message_dtype(info_message)
+config_dtype = message_dtype(config_message)
+
+# message size by id, 0 for unknown ids
+_size_table = numpy.zeros(256, numpy.int64)
+for message_id, size in message_size.items():
+    _size_table[message_id] = size
+
+def _is_hex_dump(filename):
+    with open(filename, "rb") as f:
+        start = f.read(4096)
+    return len(start) > 0 and set(start) <= _hex_characters
+
+def _parse_hex_dump(filename):
+    # dump_message prints the length in front of the data, so only the last word of every line is used
+    chunks = []
+    with open(filename) as f:
+        for line in f:
+            words = line.split()
+            if len(words) > 0:
+                chunks.append(words[-1])
+    return numpy.frombuffer(bytes.fromhex("".join(chunks)), numpy.uint8)
+
+def load_capture(filename):
+    if _is_hex_dump(filename):
+        return _parse_hex_dump(filename)
+    if os.path.getsize(filename) == 0:
+        return numpy.zeros(0, numpy.uint8)
+    return numpy.memmap(filename, numpy.uint8, mode="r")
+
+# Returns the start offsets of all valid frames in data.
+def find_frames(data):
+    if len(data) < 5:
+        return numpy.zeros(0, numpy.int64)
+    starts = numpy.flatnonzero((data[:-1] == DEVICE_MAGIC >> 8) & (data[1:] == DEVICE_MAGIC & 0xFF))
+    starts = starts[starts + 4 <= len(data)]
+    sizes = _size_table[data[starts + 3]]
+    keep = (sizes > 0) & (starts + sizes <= len(data))
+    starts = starts[keep]
+    ends = starts + sizes[keep]
+
+    # the checksum is 255 minus the sum of the bytes before it, which is a difference of two prefix sums. Only the
+    # lowest byte matters, so the sums can wrap around in 8 bits.
+    prefix = numpy.zeros(len(data) + 1, numpy.uint8)
+    numpy.cumsum(data, dtype=numpy.uint8, out=prefix[1:])
+    crc = numpy.uint8(255) - (prefix[ends - 1] - prefix[starts])
+    valid = crc == data[ends - 1]
+    starts = starts[valid]
+    ends = ends[valid]
+
+    # a header inside a valid frame that happens to pass the checksum as well isn't a frame. Like the streaming decoder,
+    # the next frame is the first candidate after the end of the previous frame that was kept. Almost every candidate is
+    # followed directly by the next one, the chain only has to be followed one by one where a candidate overlaps.
+    if len(starts) > 1:
+        index = numpy.arange(len(starts))
+        following = numpy.searchsorted(starts, ends)
+        overlaps = numpy.flatnonzero(following != index + 1)
+        kept = []
+        i = 0
+        while i < len(starts):
+            k = numpy.searchsorted(overlaps, i)
+            if k == len(overlaps):
+                kept.append(index[i:])
+                break
+            kept.append(index[i:overlaps[k] + 1])
+            i = following[overlaps[k]]
+        starts = starts[numpy.concatenate(kept)]
+    return starts
+
+def _records(data, starts, dtype):
+    if len(data) < dtype.itemsize:
+        return numpy.zeros(0, dtype)
+    # picking rows of a sliding window view copies just the frames
+    frames = numpy.lib.stride_tricks.sliding_window_view(data, dtype.itemsize)[starts]
+    return numpy.ascontiguousarray(frames).view(dtype).ravel()
+
+# Columns of the record fields of a message, with the same scaling as the codec.
+def unpack_records(codec, records):
+    columns = {"device_address":records["device_address"]}
+    for name, format, scale, index, shifts in codec.fields:
+        if shifts == None:
+            values = records[name]
+        else:
+            values = (records[name + "_high"].astype(numpy.uint32) << shifts[0]) + records[name + "_low"]
+        columns[name] = values / scale if scale != 1 else values
+    return columns
+
+def unpack_info_records(records):
+    return unpack_records(info_message, records)
+
+def unpack_config_records(records):
+    return unpack_records(config_message, records)
+
+# Decodes a capture into columns: {"info":{name:array}, "config":{name:array}}. Every column has an "offset" array
+# with the position of the frames in the capture.
+def decode_capture(filename):
+    data = load_capture(filename)
+    starts = find_frames(data)
+    message_ids = data[starts + 3]
+    result = {}
+    for name, message_id, dtype, unpack in [("info", 1, info_dtype, unpack_info_records), ("config", 2, config_dtype, unpack_config_records)]:
+        offsets = starts[message_ids == message_id]
+        columns = {"offset":offsets}
+        columns.update(unpack(_records(data, offsets, dtype)))
+        result[name] = columns
+    return result
+
+def write_csv(filename, columns):
+    names = list(columns.keys())
+    formats = ["%.1f" if columns[name].dtype.kind == "f" else "%d" for name in names]
+    table = numpy.column_stack([columns[name] for name in names]) if len(columns[names[0]]) > 0 else numpy.zeros((0, len(names)))
+    numpy.savetxt(filename, table, fmt=formats, delimiter=",", header=",".join(["\"%s\"" % name for name in names]), comments="")
+
+def write_parquet(filename, columns):
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("parquet output requires the pyarrow module")
+    pyarrow.parquet.write_table(pyarrow.table(columns), filename)
+
+# Writes <prefix>.info.<format> and <prefix>.config.<format> (or one <prefix>.npz with info_ and config_ arrays).
+def write_decoded(prefix, decoded, format="csv"):
+    filenames = []
+    if format == "npz":
+        filename = prefix + ".npz"
+        numpy.savez(filename, **{"%s_%s" % (kind, name):values for kind, columns in decoded.items() for name, values in columns.items()})
+        filenames.append(filename)
+    else:
+        for kind, columns in decoded.items():
+            filename = "%s.%s.%s" % (prefix, kind, format)
+            if format == "csv":
+                write_csv(filename, columns)
+            elif format == "parquet":
+                write_parquet(filename, columns)
+            else:
+                raise ValueError("unknown format %s" % format)
+            filenames.append(filename)
+    return filenames
@@ -0,0 +1,145 @@
+# Database outputs for logged samples.
+
+# Used like the text sinks, but the records go into a database, in batches: they are collected and written in one
+# transaction (or one request) when batch_size of them are waiting or commit_interval seconds have passed. The
+# database is given as
+#
+#   samples.db, sqlite:samples.db                   an SQLite file in WAL mode, with an index on (address, time)
+#   http://localhost:8086/api/v2/write?bucket=wls   an InfluxDB compatible endpoint taking the line protocol
+#
+# The samples go into the table (or measurement) "samples", the rolled-up records of --aggregate into "aggregates".
+# For InfluxDB 2 the token is taken from INFLUX_TOKEN. Records that couldn't be sent are sent again with the next
+# batch, up to max_pending of them. Both block while writing, --pipeline moves that out of the event loop.
+
+import os
+import sys
+import time
+
+from sinks import FieldGetter
+
+def _column_type(value):
+    if isinstance(value, int):
+        return "INTEGER"
+    elif isinstance(value, float):
+        return "REAL"
+    return "TEXT"
+
+class _BatchSink:
+    def __init__(self, fields, batch_size=1000, commit_interval=1.0):
+        self.fields = fields
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.batch = []
+        self.committed = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def write(self, record):
+        self.batch.append(record)
+        if len(self.batch) >= self.batch_size or time.monotonic() - self.committed >= self.commit_interval:
+            self.flush()
+
+    def flush(self):
+        self.committed = time.monotonic()
+        if len(self.batch) > 0:
+            self.commit(self.batch)
+            self.batch = []
+
+    def close(self):
+        self.flush()
+
+class SqliteSink(_BatchSink):
+    def __init__(self, filename, fields, table="samples", **kwargs):
+        super().__init__(fields, **kwargs)
+        import sqlite3
+        # the table is created with the first record, so address and time have to be columns
+        self.columns = list(dict.fromkeys(["address", "time"] + fields))
+        self.values = FieldGetter(self.columns)
+        self.table = table
+        self.connection = sqlite3.connect(filename)
+        # readers don't block the writer, and a commit doesn't wait for the data to be on disk, only for the log
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.insert = "INSERT INTO %s (%s) VALUES (%s)" % (table, ",".join(self.columns), ",".join(["?"] * len(self.columns)))
+        self.created = False
+
+    def _create(self, record):
+        columns = ",".join(["%s %s" % (column, _column_type(record[column])) for column in self.columns])
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS %s (%s)" % (self.table, columns))
+            self.connection.execute("CREATE INDEX IF NOT EXISTS %s_address_time ON %s (address, time)" % (self.table, self.table))
+        self.created = True
+
+    def commit(self, records):
+        if not self.created:
+            self._create(records[0])
+        # one transaction for the batch, the statement is prepared once
+        with self.connection:
+            self.connection.executemany(self.insert, map(self.values, records))
+
+    def close(self):
+        super().close()
+        self.connection.close()
+
+def _escape_tag(text):
+    return text.replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+def _format_field(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    elif isinstance(value, int):
+        return "%ii" % value
+    elif isinstance(value, float):
+        return repr(value)
+    return "\"%s\"" % str(value).replace("\\", "\\\\").replace("\"", "\\\"")
+
+# measurement,address=<address> <field>=<value>,... <time in ns>
+def format_line(measurement, record, fields):
+    values = ",".join(["%s=%s" % (field, _format_field(record[field])) for field in fields if field not in ("address", "time") and record[field] != None])
+    return "%s,address=%s %s %i" % (measurement, _escape_tag(str(record["address"])), values, round(record["time"] * 1e9))
+
+class InfluxSink(_BatchSink):
+    def __init__(self, url, fields, measurement="samples", timeout=10.0, max_pending=100000, **kwargs):
+        super().__init__(fields, **kwargs)
+        self.url = url
+        self.measurement = measurement
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.pending = []
+        self.failed = False
+        self.headers = {"Content-Type":"text/plain; charset=utf-8"}
+        token = os.environ.get("INFLUX_TOKEN")
+        if token != None:
+            self.headers["Authorization"] = "Token %s" % token
+        if "precision=" not in url:
+            self.url += ("&" if "?" in url else "?") + "precision=ns"
+
+    def commit(self, records):
+        import urllib.request
+        self.pending += [format_line(self.measurement, record, self.fields) for record in records]
+        if len(self.pending) > self.max_pending:
+            del self.pending[:len(self.pending) - self.max_pending]
+        request = urllib.request.Request(self.url, "\n".join(self.pending).encode(), self.headers)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                response.read()
+        except OSError as e:
+            if not self.failed:
+                print ("can't write to %s: %s, keeping the samples" % (self.url, e), file=sys.stderr)
+            self.failed = True
+            return
+        if self.failed:
+            print ("writing to %s again" % self.url, file=sys.stderr)
+        self.failed = False
+        self.pending = []
+
+def open_database(database, fields, table="samples", **kwargs):
+    if database.startswith("http://") or database.startswith("https://"):
+        return InfluxSink(database, fields, measurement=table, **kwargs)
+    if database.startswith("sqlite:"):
+        database = database[len("sqlite:"):]
+    return SqliteSink(database, fields, table, **kwargs)
@@ -0,0 +1,227 @@
+# Protocol core of the sensor emulator, without any Bluetooth code.
+
+# sensor.py runs this on a MicroPython board behind aioble, simulation.py runs it in-process for the host, so it has
+# to stay within what MicroPython supports. The messages are packed with the codecs from protocol.py.
+#
+# The values the emulator reports come from a simulation mode:
+#  - static: fixed values that only change when the host configures them
+#  - charge, discharge: a constant charge or load current until the battery is full or empty
+#  - cycle: charges to 95% and discharges to 20% again and again
+#  - solar: a solar panel during the day and a constant load, so it discharges at night
+# The non-static modes model a LiFePO4 battery: the voltage follows the state of charge and the current (with an
+# internal resistance), the temperature follows the time of day and warms up with the current, and the energy
+# counters count up (and wrap around at 24 bit) with the energy going in and out. The mode can be given, or is taken
+# from the device name (renaming a device to "esp32-solar" switches it to solar).
+
+import math
+import struct
+from protocol import HOST_MAGIC, calc_crc, device_message, info_message, config_message
+
+def _log_nothing(*args):
+    pass
+
+# Battery current in A (positive is charging) of the modes, for the emulator at the simulated time of day.
+def _charge_current(emulator, clock):
+    return 30.0 if emulator.soc < 1.0 else 0.0
+
+def _discharge_current(emulator, clock):
+    return -20.0 if emulator.soc > 0.0 else 0.0
+
+def _cycle_current(emulator, clock):
+    if emulator.charging and emulator.soc >= 0.95:
+        emulator.charging = False
+    elif not emulator.charging and emulator.soc <= 0.2:
+        emulator.charging = True
+    return 30.0 if emulator.charging else -20.0
+
+def _solar_current(emulator, clock):
+    hour = clock / 3600 % 24
+    sun = math.sin((hour - 6) / 12 * math.pi) if 6 < hour < 18 else 0.0
+    current = 40.0 * sun - 5.0
+    if (current > 0 and emulator.soc >= 1.0) or (current < 0 and emulator.soc <= 0.0):
+        return 0.0
+    return current
+
+modes = {
+    "static": None,
+    "charge": _charge_current,
+    "discharge": _discharge_current,
+    "cycle": _cycle_current,
+    "solar": _solar_current,
+}
+
+# open circuit voltage of a LiFePO4 cell over the state of charge
+_cell_voltage = [(0.0, 2.5), (0.1, 3.0), (0.2, 3.2), (0.9, 3.35), (1.0, 3.5)]
+
+def open_circuit_voltage(soc):
+    for (soc0, voltage0), (soc1, voltage1) in zip(_cell_voltage, _cell_voltage[1:]):
+        if soc <= soc1:
+            return voltage0 + (voltage1 - voltage0) * (max(soc, soc0) - soc0) / (soc1 - soc0)
+    return _cell_voltage[-1][1]
+
+# The mode a device name asks for, like esp32-solar.
+def mode_for_name(name):
+    for mode in modes:
+        if mode in name:
+            return mode
+    return "static"
+
+class Emulator:
+    # cells in series, capacity in Ah and internal resistance in Ohm of the simulated battery
+    cells = 4
+    full_capacity = 100.0
+    resistance = 0.01
+    # the longest step of the simulation, longer ones are split
+    max_step = 60.0
+
+    def __init__(self, device_name="esp32-energy", log=print, mode=None):
+        self.log = log if log != None else _log_nothing
+        self.on_backlight = None
+        self.messages = []
+
+        self.device_name = device_name
+
+        self.percentage = 90
+        self.backlight_mode = 0 # NO, NC, AUTO = normally on, normally off, auto
+        self.full_battery_voltage = 20
+        self.low_voltage_alarm = 100
+        self.high_voltage_alarm = 300
+        self.over_current_alarm = 40
+        self.rated_capacity = 50
+        self.under_battery_voltage = 50
+        self.device_address = 4
+
+        self.voltage = 720
+        self.capacity = 3000
+        self.temperature = 220
+        self.charge_energy = 2000
+        self.discharge_energy = 2000
+        self.current = 100
+
+        # simulated time of day in seconds
+        self.clock = 8 * 3600.0
+        self.charging = False
+        self.set_mode(mode if mode != None else mode_for_name(device_name))
+
+    def set_mode(self, mode):
+        self.mode = mode
+        self.battery_current = modes[mode]
+        self.soc = self.percentage / 100
+        self.battery_temperature = self.temperature / 10
+        # the energy counters in Wh, with the fractions that weren't counted yet
+        self.charge_wh = float(self.charge_energy)
+        self.discharge_wh = float(self.discharge_energy)
+
+    # Advances the simulation by the given number of seconds.
+    def step(self, seconds):
+        if self.battery_current == None:
+            return
+        while seconds > 0:
+            dt = min(seconds, self.max_step)
+            seconds -= dt
+            self.clock += dt
+            current = self.battery_current(self, self.clock)
+            voltage = self.cells * open_circuit_voltage(self.soc) + current * self.resistance
+            self.soc = min(1.0, max(0.0, self.soc + current * dt / 3600 / self.full_capacity))
+            if current > 0:
+                self.charge_wh += voltage * current * dt / 3600
+            else:
+                self.discharge_wh -= voltage * current * dt / 3600
+            # ambient temperature between 15 at night and 25 in the afternoon, warmer with a high current
+            ambient = 20 - 5 * math.cos((self.clock / 3600 - 3) / 12 * math.pi)
+            target = ambient + 0.1 * abs(current)
+            self.battery_temperature += (target - self.battery_temperature) * min(1.0, dt / 600)
+
+            self.percentage = round(self.soc * 100)
+            self.capacity = round(self.soc * self.full_capacity * 10)
+            self.voltage = round(voltage * 10)
+            self.current = round(abs(current) * 10)
+            self.temperature = round(self.battery_temperature * 10)
+            self.charge_energy = int(self.charge_wh) % (1 << 24)
+            self.discharge_energy = int(self.discharge_wh) % (1 << 24)
+
+    # The next message to send: the answer to a request if there is one, the main display data otherwise.
+    def next_frame(self) -> bytes:
+        if len(self.messages) > 0:
+            message = self.messages.pop(0)
+        else:
+            message = 0x01
+        if message == 0x01:
+            # main display data:
+            return info_message.pack(self.device_address, self.percentage, self.capacity, self.voltage, self.current, self.charge_energy, self.discharge_energy, self.temperature, 33)
+        elif message == 0x02:
+            # config data:
+            return config_message.pack(self.device_address, self.backlight_mode, self.full_battery_voltage, self.low_voltage_alarm, self.high_voltage_alarm, self.over_current_alarm, self.rated_capacity, 5, 3, self.under_battery_voltage, 2)
+        else:
+            # set config (or anything else):
+            # B55B010A000000A83C
+            return device_message(message).pack(self.device_address, 0, 0, 0xA8) # sometimes 0xE8
+
+    def connected(self):
+        self.messages.extend([1,2])
+
+    def handle_message(self, data : bytes):
+        log = self.log
+        if data != None and len(data) >= 5:
+            crc = calc_crc(data[0:len(data)-1])
+            magic,_,cmd = struct.unpack_from(">HBB", data, 0)
+            buf_crc, = struct.unpack_from(">B", data, len(data)-1)
+            if magic == HOST_MAGIC and crc == buf_crc:
+                # a55a000100000000ff -> sent on main screen
+                # a55a000200000000fe -> sent on setup screen
+                # a55a000300000000fd -> sent for callibration?
+                if cmd >= 4:
+                    self.messages.extend([cmd, 2])
+                else:
+                    self.messages.append(cmd)
+                short_val = struct.unpack_from(">H", data, 4)[0]
+                byte_val = struct.unpack_from(">B", data, 4)[0]
+                if cmd == 0x04:
+                    calibrating_current = short_val
+                    log ("calibrating current: %i" % calibrating_current)
+                elif cmd == 0x05:
+                    calibrating_voltage = short_val
+                    log ("calibrating voltage: %i" % calibrating_voltage)
+                elif cmd == 0x06:
+                    self.full_battery_voltage = short_val
+                    log("full battery voltage: %i" % self.full_battery_voltage)
+                elif cmd == 0x07:
+                    self.low_voltage_alarm = short_val
+                    log ("low voltage alarm: %i" % self.low_voltage_alarm)
+                elif cmd == 0x08:
+                    self.high_voltage_alarm = short_val
+                    log ("high voltage alarm: %i" % self.high_voltage_alarm)
+                elif cmd == 0x09:
+                    self.over_current_alarm = short_val
+                    log ("over current alarm: %i" % self.over_current_alarm)
+                elif cmd == 0x0A:
+                    self.rated_capacity = short_val
+                    log ("rated capacity: %i" % self.rated_capacity)
+                elif cmd == 0x0B:
+                    self.percentage = byte_val
+                    self.soc = self.percentage / 100
+                    log ("percentage: %i" % self.percentage)
+                elif cmd == 0x0C:
+                    self.device_address = byte_val
+                    log ("device address: %i" % self.device_address)
+                elif cmd == 0x0D:
+                    self.backlight_mode = byte_val
+                    log ("back light mode: %i" % self.backlight_mode)
+                    if self.on_backlight != None:
+                        self.on_backlight(self.backlight_mode)
+                elif cmd == 0x0E:
+                    self.under_battery_voltage = short_val
+                    log ("under battery voltage: %i" % self.under_battery_voltage)
+            elif magic == HOST_MAGIC and cmd == 0x10:
+                self.messages.append(cmd)
+                l = 0
+                while l < len(data) - 4 and data[4+l] != 0:
+                    l += 1
+                self.device_name = struct.unpack_from(">%is" % l, data, 4)[0].decode()
+                log ("name: %s" % self.device_name)
+                mode = mode_for_name(self.device_name)
+                if mode != "static" and mode != self.mode:
+                    self.set_mode(mode)
+                    log ("mode: %s" % mode)
+
+            log ("".join(["%2.2x" % x for x in data]))
@@ -0,0 +1,142 @@
+# Energy accounting from the charge and discharge counters of the devices.
+
+# The counters are 24 bit and only go up, so the energy of a period is the sum of their increases between samples. A
+# counter that goes down either wrapped around (it was close to the maximum and is small again) or was reset, e.g. by
+# recalibrating the device; after a reset the new value is the increase. A counter that jumps up implausibly far was
+# set as well, that jump isn't counted. As a cross-check, voltage * current is integrated between samples as well (in
+# Wh), except across gaps where the device didn't answer.
+#
+# Totals per device and local day and month are kept in a small JSON state file, together with the last counter
+# values, so logging can be stopped and started again without losing or counting anything twice, and a report only
+# reads the totals:
+#
+#   {"devices": {"<address>": {"last": {...}, "days": {"2024-01-31": {...}}, "months": {"2024-01": {...}}}}}
+
+import os
+import sys
+import json
+import time
+
+counter_max = 1 << 24
+max_jump = counter_max // 4
+counters = ["charge_energy", "discharge_energy"]
+
+# no integration across gaps longer than this (seconds)
+max_gap = 300
+# days are dropped from the state after this many days, months are kept
+keep_days = 400
+
+def default_state_file():
+    state_dir = os.environ.get("XDG_STATE_HOME", os.path.join(os.path.expanduser("~"), ".local", "state"))
+    return os.path.join(state_dir, "wls-mvaxxx", "energy.json")
+
+def _new_totals():
+    return {"charge_energy":0, "discharge_energy":0, "integrated_wh":0.0, "samples":0, "resets":0}
+
+# The increase of a counter from last to value, and whether the counter was reset. A jump by more than a quarter of the
+# counter range between two samples can't be real, it's a counter that was set to a new value.
+def counter_increase(last, value):
+    if value >= last:
+        increase = value - last
+    elif last > counter_max * 3 // 4 and value < counter_max // 4:
+        # a wrap around only ever goes from close to the maximum to close to 0
+        increase = value + counter_max - last
+    else:
+        return (value, True) if value <= max_jump else (0, True)
+    if increase > max_jump:
+        return 0, True
+    return increase, False
+
+class EnergyAccount:
+    def __init__(self, filename=None, save_interval=60.0):
+        self.filename = filename if filename != None else default_state_file()
+        self.save_interval = save_interval
+        self.saved = time.monotonic()
+        self.devices = {}
+        self.load()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.save()
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                self.devices = json.load(f).get("devices", {})
+        except FileNotFoundError:
+            self.devices = {}
+        except (OSError, ValueError) as e:
+            print ("can't read energy state %s: %s" % (self.filename, e), file=sys.stderr)
+            self.devices = {}
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        temp = self.filename + ".tmp"
+        with open(temp, "w") as f:
+            json.dump({"devices":self.devices}, f)
+        os.replace(temp, self.filename)
+        self.saved = time.monotonic()
+
+    # Adds one sample (with address and time) to the totals.
+    def update(self, info):
+        device = self.devices.get(info["address"])
+        if device == None:
+            device = {"last":None, "days":{}, "months":{}}
+            self.devices[info["address"]] = device
+        local = time.localtime(info["time"])
+        day = time.strftime("%Y-%m-%d", local)
+        month = day[:7]
+        totals = []
+        for period, key in [("days", day), ("months", month)]:
+            entry = device[period].get(key)
+            if entry == None:
+                entry = _new_totals()
+                device[period][key] = entry
+                if period == "days":
+                    self._prune(device, info["time"])
+            totals.append(entry)
+
+        power = info["voltage"] * info["current"]
+        last = device["last"]
+        increases = {}
+        resets = 0
+        wh = 0.0
+        if last != None:
+            for name in counters:
+                increase, reset = counter_increase(last[name], info[name])
+                increases[name] = increase
+                resets += reset
+            elapsed = info["time"] - last["time"]
+            if 0 < elapsed <= max_gap:
+                # trapezoid between the two samples
+                wh = (power + last["power"]) / 2 * elapsed / 3600
+        device["last"] = {"time":info["time"], "power":power, "charge_energy":info["charge_energy"], "discharge_energy":info["discharge_energy"]}
+
+        for entry in totals:
+            for name, increase in increases.items():
+                entry[name] += increase
+            entry["integrated_wh"] += wh
+            entry["samples"] += 1
+            entry["resets"] += resets
+
+        if time.monotonic() - self.saved >= self.save_interval:
+            self.save()
+
+    def _prune(self, device, now):
+        oldest = time.strftime("%Y-%m-%d", time.localtime(now - keep_days * 24 * 60 * 60))
+        for day in [day for day in device["days"] if day < oldest]:
+            del device["days"][day]
+
+    # Totals of one period ("days" or "months"): {address: {period: totals}}, optionally only of one device and key.
+    def report(self, period="days", address=None, key=None):
+        result = {}
+        for device_address, device in self.devices.items():
+            if address != None and device_address.upper() != address.upper():
+                continue
+            entries = device[period]
+            if key != None:
+                entries = {key:entries[key]} if key in entries else {}
+            result[device_address] = entries
+        return result
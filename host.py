@@ -1,36 +1,68 @@
-import asyncio
+from __future__ import annotations
 import argparse
-import struct
+import sys
+import os
+import time
+import random
 import platform
+from collections import deque
 import json
-import xml.etree.ElementTree as ET
-from bleak import BleakScanner
-from bleak import BleakClient
-from bleak import uuids
-from bleak import BleakGATTCharacteristic
-
-uart_uuid = uuids.normalize_uuid_16(0xFFF0)
-uart_receive_uuid = uuids.normalize_uuid_16(0xFFF1)
-uart_write_uuid = uuids.normalize_uuid_16(0xFFF2)
-uart_ble_config_uuid = uuids.normalize_uuid_16(0xFFF3)
-
-message_size = {
-    1:21,
-    2:21,
-    4:9,
-    5:9,
-    6:9,
-    7:9,
-    8:9,
-    9:9,
-    10:9,
-    11:9,
-    12:9,
-    13:9,
-    14:9,
-    15:9,
-    16:9
-}
+from typing import TYPE_CHECKING
+from protocol import FrameDecoder, host_messages, config_messages, unpack_info, unpack_config, unpack_info_record
+import metrics
+
+if TYPE_CHECKING:
+    from bleak import BleakClient
+    from bleak.backends.characteristic import BleakGATTCharacteristic
+
+# asyncio takes long to import, and like the simulation and tracing it isn't needed for -h or requests answered by a
+# running daemon. They're imported on first use, the module then replaces the placeholder.
+class _LazyModule:
+    def __init__(self, name):
+        self._module_name = name
+
+    def __getattr__(self, attribute):
+        import importlib
+        module = importlib.import_module(self._module_name)
+        globals()[self._module_name] = module
+        return getattr(module, attribute)
+
+asyncio = _LazyModule("asyncio")
+simulation = _LazyModule("simulation")
+tracing = _LazyModule("tracing")
+
+notifications_total = metrics.Counter("wls_notifications_total", "notifications received", ["address"])
+notification_bytes_total = metrics.Counter("wls_notification_bytes_total", "bytes received in notifications", ["address"])
+frames_total = metrics.Counter("wls_frames_total", "valid messages decoded", ["address"])
+crc_errors_total = metrics.Counter("wls_crc_errors_total", "messages with a wrong checksum", ["address"])
+skipped_bytes_total = metrics.Counter("wls_skipped_bytes_total", "bytes skipped while looking for the next message", ["address"])
+notify_queue_length = metrics.Gauge("wls_notify_queue_length", "notifications that were waiting to be decoded", ["address"])
+notifications_dropped_total = metrics.Counter("wls_notifications_dropped_total", "notifications dropped because the buffer was full", ["address"])
+timeouts_total = metrics.Counter("wls_timeouts_total", "requests the device didn't answer in time", ["address"])
+connects_total = metrics.Counter("wls_connects_total", "successful connects", ["address"])
+connect_failures_total = metrics.Counter("wls_connect_failures_total", "failed connect attempts", ["address"])
+disconnects_total = metrics.Counter("wls_disconnects_total", "connections lost", ["address"])
+request_seconds = metrics.Histogram("wls_request_seconds", "time from sending a request to the reply", ["address"])
+samples_total = metrics.Counter("wls_samples_total", "samples passed on for output", ["address"])
+duplicate_samples_total = metrics.Counter("wls_duplicate_samples_total", "samples dropped because they repeated the previous one", ["address"])
+scans_total = metrics.Counter("wls_scans_total", "scans for a device")
+scan_seconds = metrics.Histogram("wls_scan_seconds", "time to find a device by scanning", buckets=(0.5, 1, 2, 5, 10, 20, 30))
+cache_hits_total = metrics.Counter("wls_cache_hits_total", "devices found in the device cache without scanning")
+
+# bleak takes a while to import, so it's only imported by the commands that talk to a device (and not for -h or
+# requests answered by a running daemon)
+def bleak_error():
+    from bleak.exc import BleakError
+    return BleakError
+
+# the same as bleak.uuids.normalize_uuid_16
+def normalize_uuid_16(uuid):
+    return "0000%04x-0000-1000-8000-00805f9b34fb" % uuid
+
+uart_uuid = normalize_uuid_16(0xFFF0)
+uart_receive_uuid = normalize_uuid_16(0xFFF1)
+uart_write_uuid = normalize_uuid_16(0xFFF2)
+uart_ble_config_uuid = normalize_uuid_16(0xFFF3)
 
 backlight_modes = {
     0: "Normally on",
@@ -38,40 +70,196 @@ backlight_modes = {
     2: "Auto"
 }
 
-def calc_crc(message):
-    crc = 255
-    for x in message:
-        crc -= x
-    crc &= 0xFF
-    return crc
-
 def dump_message(data):
     if data != None:
         print (len(data), "".join(["%2.2x" % x for x in data]))
 
+overflow_policies = ["drop-oldest", "latest", "block"]
+
 # Async Context Managers for the notifiction callback
+# Notifications are buffered until they're read, at most max_pending of them. When the buffer is full, overflow decides
+# what happens with the next one:
+#   drop-oldest  the oldest notification is dropped (the decoder resyncs on the next header)
+#   latest       everything waiting is dropped, only the newest data is kept
+#   block        the callback waits for space. BLE has no flow control, so bleak keeps the notifications in pending
+#                callback tasks instead, nothing is lost but memory isn't bounded either
 class NotifyWrapper:
-    def __init__(self, client):
-        self.queue = asyncio.Queue()
+    def __init__(self, client, max_pending=1024, overflow="drop-oldest"):
+        if overflow not in overflow_policies:
+            raise ValueError("unknown overflow policy %s" % overflow)
         self.client = client
+        self.pending = deque()
+        self.max_pending = max_pending
+        self.overflow = overflow
+        self.closed = False
+        self.readable = asyncio.Event()
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.dropped = 0
+        self.decoder = FrameDecoder()
+        self.frames = deque()
+        address = getattr(client, "address", None)
+        self.notifications = notifications_total.labels(address)
+        self.notification_bytes = notification_bytes_total.labels(address)
+        self.dropped_total = notifications_dropped_total.labels(address)
+        self.frames_total = frames_total.labels(address)
+        self.crc_errors = crc_errors_total.labels(address)
+        self.skipped = skipped_bytes_total.labels(address)
+        self.queue_length = notify_queue_length.labels(address)
+        # set after a request was sent, so the time of the next notification is noted for tracing
+        self.waiting = False
+        self.first_notification = None
 
     async def __aenter__(self):
-        async def callback(sender: BleakGATTCharacteristic, data: bytearray):
-            await self.queue.put(data)
+        if self.overflow == "block":
+            async def callback(sender: BleakGATTCharacteristic, data: bytearray):
+                while len(self.pending) >= self.max_pending and not self.closed:
+                    self.writable.clear()
+                    await self.writable.wait()
+                self.put(data)
+        else:
+            # a plain function is called right away, without a task per notification
+            def callback(sender: BleakGATTCharacteristic, data: bytearray):
+                self.put(data)
         await self.client.start_notify(uart_receive_uuid, callback)
 
         return self
 
+    def put(self, data):
+        if self.waiting:
+            self.waiting = False
+            self.first_notification = time.perf_counter()
+        self.notifications.inc()
+        self.notification_bytes.inc(len(data))
+        pending = self.pending
+        if len(pending) >= self.max_pending:
+            if self.overflow == "latest":
+                dropped = len(pending)
+                pending.clear()
+            else:
+                dropped = 1
+                pending.popleft()
+            self.dropped += dropped
+            self.dropped_total.inc(dropped)
+        pending.append(data)
+        self.readable.set()
+
+    # Called when the link drops, readers get what's still buffered and then a ConnectionError.
+    def disconnected(self):
+        self.closed = True
+        self.readable.set()
+        self.writable.set()
+
+    async def _wait_readable(self):
+        while len(self.pending) == 0:
+            if self.closed:
+                return False
+            self.readable.clear()
+            await self.readable.wait()
+        return True
+
+    # The next notification, None once disconnected.
     async def read(self):
-        message = await self.queue.get()
+        if not await self._wait_readable():
+            return None
+        message = self.pending.popleft()
+        self.writable.set()
         return message
-    
+
+    # All notifications that are waiting (at least one), so a burst is handled in one go. Fails with a ConnectionError
+    # once disconnected.
+    async def read_batch(self):
+        if not await self._wait_readable():
+            raise ConnectionError("disconnected")
+        messages = list(self.pending)
+        self.pending.clear()
+        self.writable.set()
+        return messages
+
+    # Returns the next valid message, messages split across notifications are put back together by the decoder.
+    async def read_frame(self):
+        while len(self.frames) == 0:
+            messages = await self.read_batch()
+            decoder = self.decoder
+            frames, crc_errors, skipped = decoder.frames, decoder.crc_errors, decoder.skipped
+            for message in messages:
+                self.frames.extend(decoder.feed(message))
+            self.frames_total.inc(decoder.frames - frames)
+            self.crc_errors.inc(decoder.crc_errors - crc_errors)
+            self.skipped.inc(decoder.skipped - skipped)
+            self.queue_length.set(len(messages))
+        return self.frames.popleft()
+
     async def __aexit__(self, exc_type, exc, tb):
         await self.client.stop_notify(uart_receive_uuid) 
 
-async def list_devices():
+# Wait for a message with the given id (or any message for None), ignoring anything else the device sends in the
+# meantime.
+async def wait_for_frame(wrapper : NotifyWrapper, message_id : int, timeout=10):
+    async with asyncio.timeout(timeout):
+        while True:
+            frame = await wrapper.read_frame()
+            if message_id == None or frame.message_id == message_id:
+                return frame
+
+# Connect to a potential device and check it answers a request with a valid message.
+async def verify_device(device):
+    from bleak import BleakClient
+    async with BleakClient(device) as client:
+        # Have a look if we have a UART channel:
+        hasUartChannel = False
+        for service in client.services:
+            if service.uuid == uart_uuid:
+                for char in service.characteristics:
+                    if char.uuid == uart_receive_uuid and "read" in char.properties:
+                        hasUartChannel = True
+        # print ("hasUartChannel", hasUartChannel)
+        if hasUartChannel:
+            async with NotifyWrapper(client) as wrapper:
+                while True:
+                    # try to receive a message and check the header and checksum are correct:
+                    await send_request(client, 1)
+                    try:
+                        await wait_for_frame(wrapper, 1)
+                        return True
+                    except TimeoutError:
+                        # print("timeout")
+                        # no response
+                        pass
+    return False
+
+async def timed_verify_device(device, local_name, connect_limit, timeout):
+    async with connect_limit:
+        start = time.perf_counter()
+        try:
+            async with asyncio.timeout(timeout):
+                valid = await verify_device(device)
+            error = None
+        except TimeoutError:
+            valid = False
+            error = "timeout"
+        except (bleak_error(), OSError) as e:
+            valid = False
+            error = str(e)
+        return device, local_name, valid, error, time.perf_counter() - start
+
+async def list_devices(args):
+    cache = open_cache(args)
+    if args.cached:
+        if cache == None:
+            print ("the cache is disabled!")
+            return
+        entries = cache.entries()
+        for entry in entries:
+            print (f"{entry['address']} {entry['name']}")
+        if len(entries) == 0:
+            print ("no devices found!")
+        return
+
     print ("scanning...")
     deviceCount = 0
+    candidates = []
+    from bleak import BleakScanner
     devices = await BleakScanner.discover(return_adv=True)
     for device, adv in devices.values():
         # The manufacturer ID seems to change randomly, so let's just look at the data:
@@ -82,50 +270,33 @@ async def list_devices():
         if manufacturer_data == bytes([0x31,0x00,0x00,0x00,0x00,0x00]):
             local_name = adv.local_name
             # print (f"potential client: {device.address} {local_name}")
-            async with BleakClient(device) as client:
-                # Have a look if we have a UART channel:
-                hasUartChannel = False
-                for service in client.services:
-                    if service.uuid == uart_uuid:
-                        for char in service.characteristics:
-                            if char.uuid == uart_receive_uuid and "read" in char.properties:
-                                hasUartChannel = True
-                # print ("hasUartChannel", hasUartChannel)
-                if hasUartChannel:
-                    def isValidMessage(data):
-                        if len(message) >= 5 and struct.unpack_from(">H", message, 0)[0] == 0xB55B:
-                            crc = calc_crc(message[0:len(message)-1])
-                            if crc == message[-1]:
-                                return True
-                        return False
-
-                    async with NotifyWrapper(client) as wrapper:
-                        complete = False
-                        while not complete:
-                            # try to receive a message and check the header and checksum are correct:
-                            await send_request(client, 1)
-
-                            try:
-                                async with asyncio.timeout(10):
-                                    message = await wrapper.read()
-                                    # dump_message(message)
-
-                                    if isValidMessage(message):
-                                        print (f"{device.address} {local_name}")
-                                        complete = True
-                                        deviceCount += 1
-
-                            except TimeoutError:
-                                # print("timeout")
-                                # no response
-                                pass
+            if cache != None and cache.find(device.address) != None:
+                # verified recently, no need to connect again
+                print (f"{device.address} {local_name}" + (" (cached)" if args.timing else ""))
+                deviceCount += 1
+            else:
+                candidates.append((device, local_name))
+
+    # check the remaining candidates in parallel and print each one as soon as it answered
+    connect_limit = asyncio.Semaphore(args.concurrency)
+    tasks = [timed_verify_device(device, local_name, connect_limit, args.timeout) for device, local_name in candidates]
+    for task in asyncio.as_completed(tasks):
+        device, local_name, valid, error, elapsed = await task
+        if valid:
+            print (f"{device.address} {local_name}" + (" (%.2fs)" % elapsed if args.timing else ""))
+            deviceCount += 1
+            if cache != None:
+                cache.add(device.address, local_name, bluez_path(device))
+        elif args.timing:
+            print (f"{device.address} {local_name}: {error or 'no UART channel'} (%.2fs)" % elapsed, file=sys.stderr)
 
     if deviceCount == 0:
         print ("no devices found!")
+    if cache != None:
+        cache.save()
 
 async def send_request(client : BleakClient, msg : int):
-    data = struct.pack(">HBBI", 0xA55A, 0, msg, 0)
-    data += bytes([calc_crc(data)])
+    data = host_messages[msg].encode(0)
     # dump_message(data)
     await client.write_gatt_char(uart_write_uuid, data, response=False)
 
@@ -133,243 +304,957 @@ def output_json(info):
     print(json.dumps(info))
 
 def output_xml(root, info):
-    doc = ET.Element(root)
-    for key, value in info.items():
-        ET.SubElement(doc, key).text = str(value)
-    print (ET.tostring(doc, encoding='utf-8', xml_declaration=True).decode())
+    from sinks import format_xml
+    print ("<?xml version='1.0' encoding='utf-8'?>\n" + format_xml(root, info, list(info.keys())))
 
 def output_text(info):
     for key, value in info.items():
         print ("%s: %s" % (key, value))
 
-async def get_device(args):
+def default_cache_file():
+    cache_dir = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_dir, "wls-mvaxxx", "devices.json")
+
+# Devices that answered a request recently, so list doesn't have to connect to them again to verify them.
+# With BlueZ the D-Bus path of the device is kept as well, so bleak can connect to it without scanning. Elsewhere (or
+# for an entry without a path) bleak scans for the address itself while connecting. BlueZ forgets devices that
+# aren't connected or paired after a while, connecting to such a path fails and the device is scanned for again.
+# Entries expire after ttl seconds, after that the device has to be found and verified again.
+class DeviceCache:
+    def __init__(self, filename=None, ttl=24*60*60):
+        self.filename = filename if filename != None else default_cache_file()
+        self.ttl = ttl
+        self.devices = {}
+        self.modified = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = []
+        for entry in entries:
+            if self.is_fresh(entry):
+                self.devices[entry["address"].upper()] = entry
+            else:
+                self.modified = True
+
+    def save(self):
+        if self.modified:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            temp_filename = self.filename + ".tmp"
+            with open(temp_filename, "w") as f:
+                json.dump(list(self.devices.values()), f, indent=1)
+            os.replace(temp_filename, self.filename)
+            self.modified = False
+
+    def is_fresh(self, entry):
+        return time.time() - entry["last_seen"] <= self.ttl
+
+    def find(self, address=None, name=None):
+        entry = None
+        if address != None:
+            entry = self.devices.get(address.upper())
+        elif name != None:
+            for device in self.devices.values():
+                if device["name"] == name:
+                    entry = device
+        if entry != None and not self.is_fresh(entry):
+            del self.devices[entry["address"].upper()]
+            self.modified = True
+            entry = None
+        return entry
+
+    def entries(self):
+        return [entry for entry in self.devices.values() if self.is_fresh(entry)]
+
+    def remove(self, address):
+        if self.devices.pop(address.upper(), None) != None:
+            self.modified = True
+
+    def add(self, address, name, path=None):
+        self.devices[address.upper()] = {
+            "address":address,
+            "name":name,
+            "last_seen":time.time(),
+            "path":path
+        }
+        self.modified = True
+
+# The BlueZ D-Bus path of a device found by scanning, None on other platforms.
+def bluez_path(device):
+    details = getattr(device, "details", None)
+    if isinstance(details, dict):
+        return details.get("path")
+    return None
+
+# What bleak can connect to for a cache entry: a BLEDevice with the D-Bus path if there is one, the address otherwise.
+def cached_device(entry):
+    if entry.get("path") == None:
+        return entry["address"]
+    from bleak.backends.device import BLEDevice
+    return BLEDevice(entry["address"], entry["name"], {"path":entry["path"], "props":None})
+
+def open_cache(args):
+    if args.no_cache:
+        return None
+    return DeviceCache(args.cache_file, args.cache_ttl)
+
+def device_address_arg(args):
+    return args.uuid if platform.system() == 'Darwin' else args.mac
+
+# Returns the BLEDevice found by scanning, or what cached_device returns for a device in the cache.
+async def get_device(args, cache=None):
     device = None
-    if platform.system() != 'Darwin' and args.mac != None:
-        device = await BleakScanner.find_device_by_address(args.mac)
-    elif platform.system() == 'Darwin' and args.uuid != None:
-        device = await BleakScanner.find_device_by_address(args.uuid)
+    address = device_address_arg(args)
+    if simulation.is_simulated(address):
+        return address
+    if cache != None:
+        entry = cache.find(address, args.name)
+        if entry != None:
+            cache_hits_total.inc()
+            return cached_device(entry)
+    from bleak import BleakScanner
+    start = time.perf_counter()
+    if address != None:
+        device = await BleakScanner.find_device_by_address(address)
     elif args.name != None:
         device = await BleakScanner.find_device_by_name(args.name)
+    elapsed = time.perf_counter() - start
+    scans_total.inc()
+    scan_seconds.observe(elapsed)
+    tracing.record(address if address != None else args.name, "scan", elapsed, "ok" if device != None else "not found")
     if device == None:
         print ("device not found!")
     return device
 
+def trace_status(error):
+    if isinstance(error, TimeoutError):
+        return "timeout"
+    return str(error) or type(error).__name__
+
+# The transport for a device: a BleakClient, or a simulated device for sim: addresses.
+def create_client(device, disconnected_callback=None):
+    if simulation.is_simulated(device):
+        return simulation.SimulatedClient(device, disconnected_callback=disconnected_callback)
+    from bleak import BleakClient
+    return BleakClient(device, disconnected_callback=disconnected_callback)
+
+def device_connection(device, cache=None, **kwargs):
+    if isinstance(device, str):
+        return DeviceConnection(device, cache=cache, **kwargs)
+    return DeviceConnection(device.address, device, cache=cache, **kwargs)
+
+# DeviceConnection settings for the notification buffer
+def buffer_options(args):
+    return {"max_pending":args.notify_buffer, "overflow":args.overflow}
+
+# Raised by DeviceConnection.connect when max_attempts connects in a row failed.
+class ConnectFailed(Exception):
+    pass
+
+# Keeps the connection to one device open, so a daemon or a long running log can use it for all requests.
+# When the link drops, the next request reconnects, waiting longer after every failed attempt. Long running commands
+# keep trying, one-shot commands give up after max_attempts.
+class DeviceConnection:
+    def __init__(self, address, device=None, connect_limit=None, min_backoff=1.0, max_backoff=60.0, cache=None, max_pending=1024, overflow="drop-oldest", max_attempts=None):
+        self.address = address
+        self.max_attempts = max_attempts
+        self.max_pending = max_pending
+        self.overflow = overflow
+        self.device = device
+        self.cache = cache
+        self.name = getattr(device, "name", None)
+        self.connect_limit = connect_limit
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.client = None
+        self.wrapper = None
+        self.connects = 0
+        # one request/response cycle at a time, replies don't say which request they belong to
+        self.lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    @property
+    def is_connected(self):
+        return self.client != None and self.client.is_connected
+
+    def _disconnected(self, client):
+        if client is self.client and self.wrapper != None:
+            # wake up a request waiting for a reply that won't come
+            self.wrapper.disconnected()
+
+    async def _connect_once(self):
+        # without a BLEDevice bleak looks for the address itself
+        device = self.device if self.device != None else self.address
+        client = create_client(device, disconnected_callback=self._disconnected)
+        start = time.perf_counter()
+        try:
+            await client.connect()
+        except Exception as e:
+            tracing.record(self.address, "connect", time.perf_counter() - start, trace_status(e))
+            raise
+        tracing.record(self.address, "connect", time.perf_counter() - start)
+        wrapper = NotifyWrapper(client, self.max_pending, self.overflow)
+        start = time.perf_counter()
+        try:
+            await wrapper.__aenter__()
+        except Exception as e:
+            tracing.record(self.address, "start_notify", time.perf_counter() - start, trace_status(e))
+            await client.disconnect()
+            raise
+        except:
+            await client.disconnect()
+            raise
+        tracing.record(self.address, "start_notify", time.perf_counter() - start)
+        self.client = client
+        self.wrapper = wrapper
+        self.connects += 1
+        connects_total.labels(self.address).inc()
+
+    async def connect(self):
+        backoff = self.min_backoff
+        attempts = 0
+        while not self.is_connected:
+            await self._drop()
+            try:
+                # BLE adapters don't cope well with many devices scanning and connecting at the same time
+                if self.connect_limit != None:
+                    async with self.connect_limit:
+                        await self._connect_once()
+                else:
+                    await self._connect_once()
+            except (bleak_error(), OSError, TimeoutError) as e:
+                connect_failures_total.labels(self.address).inc()
+                self._forget()
+                attempts += 1
+                if self.max_attempts != None and attempts >= self.max_attempts:
+                    print ("%s: %s, giving up" % (self.address, str(e) or type(e).__name__), file=sys.stderr)
+                    raise ConnectFailed(self.address)
+                print ("%s: %s, retrying in %.0fs" % (self.address, str(e) or type(e).__name__, backoff), file=sys.stderr)
+                # the device might have to be found again
+                self.device = None
+                # spread out the reconnects of devices that dropped at the same time
+                await asyncio.sleep(backoff * random.uniform(0.5, 1.0))
+                backoff = min(backoff * 2, self.max_backoff)
+
+    # The device answered, so it's worth remembering.
+    def _remember(self):
+        if self.cache != None and not simulation.is_simulated(self.address):
+            entry = self.cache.find(self.address)
+            if entry == None:
+                self.cache.add(self.address, self.name, bluez_path(self.device))
+                self.cache.save()
+            elif self.name == None:
+                self.name = entry["name"]
+
+    # The device didn't answer, it might have moved or been removed, so it has to be found by scanning again.
+    def _forget(self):
+        if self.cache != None and self.cache.find(self.address) != None:
+            self.cache.remove(self.address)
+            self.cache.save()
+
+    async def _drop(self):
+        client = self.client
+        self.client = None
+        self.wrapper = None
+        if client != None:
+            try:
+                await client.disconnect()
+            except (bleak_error(), OSError, TimeoutError):
+                pass
+
+    async def close(self):
+        async with self.lock:
+            await self._drop()
+
+    def _lost(self):
+        disconnects_total.labels(self.address).inc()
+        print ("%s: connection lost" % self.address, file=sys.stderr)
+
+    # Send a message with send(client, *args), (re)establishing the link as needed.
+    async def send(self, send, *args):
+        while True:
+            await self.connect()
+            self.wrapper.waiting = True
+            self.wrapper.first_notification = None
+            start = time.perf_counter()
+            try:
+                await send(self.client, *args)
+                tracing.record(self.address, "write", time.perf_counter() - start)
+                return
+            except (bleak_error(), ConnectionError) as e:
+                tracing.record(self.address, "write", time.perf_counter() - start, trace_status(e))
+                self._lost()
+                await self._drop()
+
+    # Wait for a message with the given id without asking for it. Fails with a ConnectionError if the link drops.
+    async def receive(self, message_id, timeout=10):
+        await self.connect()
+        try:
+            frame = await wait_for_frame(self.wrapper, message_id, timeout)
+        except ConnectionError:
+            self._lost()
+            await self._drop()
+            raise
+        self._remember()
+        return frame
+
+    # Send a message and wait for the reply with the given id. The link is (re)established as needed, so this only
+    # fails with a TimeoutError when the device doesn't answer.
+    async def request(self, reply_id, send, *args, timeout=10):
+        async with self.lock:
+            while True:
+                await self.send(send, *args)
+                start = time.perf_counter()
+                try:
+                    frame = await self.receive(reply_id, timeout)
+                    self.replied(start)
+                    return frame
+                except TimeoutError:
+                    self.timed_out(start)
+                    raise
+                except ConnectionError:
+                    # reconnect and ask again
+                    self.trace_reply(start, "disconnected")
+
+    # The reply to a request that was sent at start arrived.
+    def replied(self, start, latency=None):
+        now = time.perf_counter()
+        (latency or request_seconds.labels(self.address)).observe(now - start)
+        self.trace_reply(start)
+
+    def timed_out(self, start, timeouts=None):
+        (timeouts or timeouts_total.labels(self.address)).inc()
+        self.trace_reply(start, "timeout")
+
+    def trace_reply(self, start, status="ok"):
+        if tracing.tracer == None:
+            return
+        now = time.perf_counter()
+        first = self.wrapper.first_notification if self.wrapper != None else None
+        if first != None:
+            tracing.record(self.address, "first_notification", max(first - start, 0.0))
+        else:
+            tracing.record(self.address, "first_notification", now - start, status if status != "ok" else "none")
+        tracing.record(self.address, "reply", now - start, status)
+
+# All connections of a process, so repeated requests to the same device reuse the open link.
+class ConnectionPool:
+    def __init__(self, max_connects=4, **kwargs):
+        self.connections = {}
+        self.connect_limit = asyncio.Semaphore(max_connects)
+        self.kwargs = kwargs
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def get(self, address, device=None):
+        connection = self.connections.get(address)
+        if connection == None:
+            connection = DeviceConnection(address, device, connect_limit=self.connect_limit, **self.kwargs)
+            self.connections[address] = connection
+        return connection
+
+    async def close(self):
+        await asyncio.gather(*[connection.close() for connection in self.connections.values()])
+        self.connections.clear()
+
+async def request_info(connection : DeviceConnection):
+    frame = await connection.request(1, send_request, 1)
+    return unpack_info(frame.data)
+
+async def request_configuration(connection : DeviceConnection, timeout=10):
+    frame = await connection.request(2, send_request, 2, timeout=timeout)
+    return unpack_config(frame.data)
+
+# The device acknowledges a configuration change with a message using the same id.
+async def write_configuration(connection : DeviceConnection, variable, value):
+    codec = config_messages[variable]
+    await connection.request(codec.message_id, send_setting, codec, value)
+
+# The connection for a one-shot command, None if the device can't be found or connected to. A device from the cache
+# that can't be connected to is looked for again by scanning.
+async def open_device_connection(args, cache):
+    cached = cache != None and cache.find(device_address_arg(args), args.name) != None
+    device = await get_device(args, cache)
+    while device != None:
+        connection = device_connection(device, cache, max_attempts=args.connect_attempts)
+        try:
+            await connection.connect()
+            return connection
+        except ConnectFailed:
+            pass
+        if not cached or simulation.is_simulated(device):
+            print ("device not found!")
+            return None
+        # the connection removed the device from the cache
+        cached = False
+        device = await get_device(args, None)
+    return None
+
 async def read_device(args):
-    device = await get_device(args)
-    if device != None:
-        async with BleakClient(device) as client:
-            async with NotifyWrapper(client) as wrapper:
-                success = False
-                while not success:
-                    await send_request(client, 1)
+    cache = open_cache(args)
+    connection = await open_device_connection(args, cache)
+    if connection != None:
+        async with connection:
+            info = None
+            while info == None:
+                try:
+                    info = await request_info(connection)
+                except TimeoutError:
+                    print ("timeout...")
+                    # no response
+                    pass
+                except ConnectFailed:
+                    # the link dropped and the device can't be reached again
+                    print ("device not found!")
+                    return
+            output_info(args, info)
+
+def output_info(args, info):
+    if args.json:
+        output_json(info)
+    elif args.xml:
+        output_xml("info", info)
+    else:
+        output_text(info)
+
+def default_socket_file():
+    return os.path.join(os.environ.get("XDG_RUNTIME_DIR", "/tmp"), "wls-mvaxxx.sock")
+
+# Asks a serve daemon listening on a Unix socket, which has the connection to the device open already. Returns None if
+# there's no daemon or it has no data for the device.
+def daemon_request(socket_file, path, timeout=2.0):
+    import socket
+    response = b""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(timeout)
+            connection.connect(socket_file)
+            connection.sendall(b"GET %s HTTP/1.0\r\n\r\n" % path.encode())
+            while True:
+                data = connection.recv(65536)
+                if len(data) == 0:
+                    break
+                response += data
+    except OSError:
+        return None
+    head, _, body = response.partition(b"\r\n\r\n")
+    if not head.startswith(b"HTTP/1.1 200 "):
+        return None
+    return json.loads(body)
+
+# How old the data of a daemon may be by default, in seconds. The configuration is only read once a minute.
+daemon_max_age = {"info":10.0, "config":120.0}
+
+# Answers read and configuration from a running daemon if possible, with the same output as from the device. Data of a
+# device the daemon isn't connected to, or that is older than --max-age, is asked for again.
+def read_from_daemon(args, kind):
+    address = device_address_arg(args)
+    if args.no_daemon or address == None:
+        return False
+    from urllib.parse import quote
+    device = daemon_request(args.daemon, "/devices/%s" % quote(address, safe=""))
+    if device == None or not device["connected"] or device[kind] == None:
+        return False
+    data = device[kind]
+    max_age = args.max_age if args.max_age != None else daemon_max_age[kind]
+    if time.time() - data["time"] > max_age:
+        return False
+    # the daemon adds where and when the data is from
+    del data["address"]
+    del data["time"]
+    if kind == "info":
+        output_info(args, data)
+    else:
+        output_config(args, data)
+    return True
+
+def read(args):
+    if not read_from_daemon(args, "info"):
+        asyncio.run(read_device(args))
+
+def read_configuration(args):
+    if not read_from_daemon(args, "config"):
+        asyncio.run(read_device_configuration(args))
+
+log_fields = ["device_address", "percentage", "capacity", "voltage", "current", "charge_energy", "discharge_energy", "temperature"]
+
+# Decides when to ask a device for the next sample. Without a rate the next request is sent as soon as the previous
+# one was answered. With an idle rate, polling slows down step by step while the current doesn't change, and goes
+# back to the full rate as soon as it does.
+class PollScheduler:
+    def __init__(self, rate=None, idle_rate=None, jitter=0.0, threshold=0.1, backoff=2.0):
+        self.fast_interval = 1.0 / rate if rate != None else 0.0
+        self.slow_interval = 1.0 / idle_rate if idle_rate != None else self.fast_interval
+        self.jitter = jitter
+        self.threshold = threshold
+        self.backoff = backoff
+        self.interval = self.fast_interval
+        self.current = None
+
+    def update(self, info):
+        current = info["current"]
+        if self.current == None or abs(current - self.current) >= self.threshold:
+            self.interval = self.fast_interval
+        elif self.interval < self.slow_interval:
+            self.interval = min(max(self.interval * self.backoff, self.fast_interval, 0.1), self.slow_interval)
+        self.current = current
+
+    # Random jitter keeps devices that were started together from being polled at the same moment.
+    def delay(self):
+        return self.interval * random.uniform(1.0 - self.jitter, 1.0 + self.jitter)
+
+# Keep requesting the main display data and pass every sample to output, as a protocol.Record.
+# Some devices (like the emulator) also send samples on their own. These are used as well, but one identical to the
+# previous sample is dropped unless it's due anyway. The reply to a request is always kept.
+async def log_samples(connection : DeviceConnection, output, scheduler=None):
+    if scheduler == None:
+        scheduler = PollScheduler()
+    loop = asyncio.get_running_loop()
+    last_data = None
+    last_time = 0
+    samples = samples_total.labels(connection.address)
+    duplicates = duplicate_samples_total.labels(connection.address)
+    timeouts = timeouts_total.labels(connection.address)
+    latency = request_seconds.labels(connection.address)
+    def handle(frame, unsolicited=False):
+        nonlocal last_data, last_time
+        now = loop.time()
+        if unsolicited and frame.data == last_data and now - last_time < scheduler.interval:
+            duplicates.inc()
+            return
+        last_data = frame.data
+        last_time = now
+        info = unpack_info_record(frame.data, connection.address, time.time())
+        scheduler.update(info)
+        samples.inc()
+        output(info)
+
+    while True:
+        async with connection.lock:
+            await connection.send(send_request, 1)
+            start = time.perf_counter()
+            try:
+                frame = await connection.receive(1)
+            except TimeoutError:
+                # no response
+                connection.timed_out(start, timeouts)
+                continue
+            except ConnectionError:
+                connection.trace_reply(start, "disconnected")
+                continue
+            connection.replied(start, latency)
+            handle(frame)
+        # take whatever the device sends until the next request is due, in short steps so other requests on the same
+        # connection don't have to wait for long
+        next_poll = loop.time() + scheduler.delay()
+        while next_poll > loop.time():
+            async with connection.lock:
+                try:
+                    handle(await connection.receive(1, min(next_poll - loop.time(), 1.0)), True)
+                except TimeoutError:
+                    pass
+                except ConnectionError:
+                    break
+
+def scheduler_factory(args):
+    return lambda: PollScheduler(args.rate, args.idle_rate, args.jitter, args.change_threshold)
+
+def open_text_sink(args, fields, filename):
+    from sinks import Output, sink_types
+    output = Output(filename, args.compress, args.rotate_size, args.rotate_interval)
+    return sink_types[args.format](fields, output, args.buffer_size, args.flush_interval)
+
+# The database if one is given, the text output otherwise.
+def open_output_sink(args, fields, table):
+    if args.database != None:
+        from database import open_database
+        return open_database(args.database, fields, table, batch_size=args.commit_size, commit_interval=args.flush_interval)
+    return open_text_sink(args, fields, args.output)
+
+# With aggregation the rolled-up records go to the output, and the samples themselves to the store or the raw output
+# if one of them is given.
+def open_sink(args, fields):
+    if args.aggregate != None:
+        from aggregate import Aggregator, aggregate_fields
+        raw = None
+        if args.store != None:
+            from storage import SampleStore
+            raw = SampleStore(args.store)
+        elif args.raw_output != None:
+            raw = open_text_sink(args, fields, args.raw_output)
+        return Aggregator(args.aggregate, open_output_sink(args, aggregate_fields, "aggregates"), raw)
+    if args.store != None:
+        from storage import SampleStore
+        return SampleStore(args.store)
+    return open_output_sink(args, fields, "samples")
+
+def open_alerts(args):
+    if args.rules == None and args.alert_exec == None and args.alert_webhook == None and args.alert_syslog == None:
+        return None
+    import alerts
+    specs = alerts.load_rules(args.rules) if args.rules != None else None
+    sinks = []
+    for command in args.alert_exec or []:
+        sinks.append(alerts.ExecSink(command))
+    for url in args.alert_webhook or []:
+        sinks.append(alerts.WebhookSink(url))
+    if args.alert_syslog != None:
+        sinks.append(alerts.SyslogSink(args.alert_syslog))
+    return alerts.AlertEngine(specs, sinks)
+
+alert_config_interval = 600
+
+# Keeps the alert thresholds of a device up to date with its configuration.
+async def watch_alert_config(connection : DeviceConnection, engine):
+    while True:
+        try:
+            engine.set_config(connection.address, await request_configuration(connection))
+            await asyncio.sleep(alert_config_interval)
+        except TimeoutError:
+            # no response, try again soon
+            await asyncio.sleep(10)
+
+# With --pipeline the sink runs in a worker thread or process, the event loop only hands batches of records over.
+def open_log_sink(args, fields):
+    if args.pipeline == None:
+        return open_sink(args, fields)
+    import functools
+    from pipeline import PipelineSink
+    # everything but the command function, which can't be sent to a worker process
+    sink_args = argparse.Namespace(**{key:value for key, value in vars(args).items() if key != "func"})
+    return PipelineSink(functools.partial(open_sink, sink_args, fields), args.pipeline, args.batch_size, flush_interval=args.flush_interval)
+
+def open_energy(args):
+    if args.energy == None:
+        return None
+    from energy import EnergyAccount
+    return EnergyAccount(args.energy)
+
+# Log several connections into one sink, all devices write into one queue so the output never interleaves. Alerts and
+# energy totals are updated before the samples are queued.
+async def log_connections(args, connections, fields):
+    samples = asyncio.Queue()
+    engine = open_alerts(args)
+    account = open_energy(args)
+    checks = []
+    tasks = []
+    if engine != None:
+        engine.start()
+        checks.append(engine.check)
+        if engine.specs == None:
+            tasks += [asyncio.create_task(watch_alert_config(connection, engine)) for connection in connections]
+    if account != None:
+        checks.append(account.update)
+    output = samples.put_nowait
+    if len(checks) > 0:
+        def checked_output(info):
+            for check in checks:
+                check(info)
+            samples.put_nowait(info)
+        output = checked_output
+    new_scheduler = scheduler_factory(args)
+    tasks += [asyncio.create_task(log_samples(connection, output, new_scheduler())) for connection in connections]
+    metrics_server = await metrics.serve_metrics(args.metrics_host, args.metrics_port) if args.metrics_port != None else None
+    try:
+        with open_log_sink(args, fields) as sink:
+            while True:
+                try:
+                    record = samples.get_nowait()
+                except asyncio.QueueEmpty:
                     try:
-                        count = 0
-                        while count < 4 and not success:
-                            async with asyncio.timeout(10):
-                                message = await wrapper.read()
-                            while len(message) > 4 and not success:
-                                # dump_message(message)
-                                magic, device_address, message_id = struct.unpack_from(">HBB", message, 0)
-                                if magic == 0xB55B and len(message) >= message_size[message_id]:
-                                    if message_id == 1:
-                                        (magic, device_address, message_id, percentage, capacity, voltage, current, charge_energy_high, charge_energy_low, discharge_energy_high, discharge_energy_low, temperature, u1, crc) = struct.unpack_from(">HBBBHHHBHBHHBB", message, 0)
-                                        if calc_crc(message[0:message_size[message_id]-1]) == crc:
-                                            success = True
-                                            info = {
-                                                "device_address":device_address,
-                                                "percentage":percentage,
-                                                "capacity":capacity/10,
-                                                "voltage":voltage/10,
-                                                "current":current/10,
-                                                "charge_energy":(charge_energy_high << 16) + charge_energy_low,
-                                                "discharge_energy":(discharge_energy_high << 16) + discharge_energy_low,
-                                                "temperature":temperature/10,
-                                                "u1":u1
-                                            }
-                                            if args.json:
-                                                output_json(info)
-                                            elif args.xml:
-                                                output_xml("info", info)
-                                            else:
-                                                output_text(info)
-                                    message = message[message_size[message_id]:]
-                                else:
-                                    message = message[1:]
-                            count += 1
+                        async with asyncio.timeout(args.flush_interval):
+                            record = await samples.get()
                     except TimeoutError:
-                        print ("timeout...")
-                        # no response
-                        pass
+                        # the devices are quiet or reconnecting, so don't keep what's collected until the next sample
+                        sink.flush()
+                        continue
+                sink.write(record)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if engine != None:
+            await engine.close()
+        if account != None:
+            account.save()
+        if metrics_server != None:
+            metrics_server.close()
 
 async def log_device(args):
-    device = await get_device(args)
+    cache = open_cache(args)
+    device = await get_device(args, cache)
     if device != None:
-        async with BleakClient(device) as client:
-            print(f"\"device_address\",\"percentage\",\"capacity\",\"voltage\",\"current\",\"charge_energy\",\"discharge_energy\",\"temperature\"")
-            async with NotifyWrapper(client) as wrapper:
-                while True:
-                    await send_request(client, 1)
-                    try:
-                        async with asyncio.timeout(10):
-                            message = await wrapper.read()
-                        while len(message) > 4:
-                            magic, device_address, message_id = struct.unpack_from(">HBB", message, 0)
-                            if magic == 0xB55B and len(message) >= message_size[message_id]:
-                                if message_id == 1:
-                                    (magic, device_address, message_id, percentage, capacity, voltage, current, charge_energy_high, charge_energy_low, discharge_energy_high, discharge_energy_low, temperature, u1, crc) = struct.unpack_from(">HBBBHHHBHBHHBB", message, 0)
-                                    if calc_crc(message[0:message_size[message_id]-1]) == crc:
-                                        info = {
-                                            "device_address":device_address,
-                                            "percentage":percentage,
-                                            "capacity":capacity/10,
-                                            "voltage":voltage/10,
-                                            "current":current/10,
-                                            "charge_energy":(charge_energy_high << 16) + charge_energy_low,
-                                            "discharge_energy":(discharge_energy_high << 16) + discharge_energy_low,
-                                            "temperature":temperature/10,
-                                            "u1":u1
-                                        }
-                                        print(f"{info["device_address"]},{info["percentage"]},{info["capacity"]},{info["voltage"]},{info["current"]},{info["charge_energy"]},{info["discharge_energy"]},{info["temperature"]}")
-                                message = message[message_size[message_id]:]
-                            else:
-                                message = message[1:]
-                    except TimeoutError:
-                        # no response
-                        pass
+        async with device_connection(device, cache, **buffer_options(args)) as connection:
+            await log_connections(args, [connection], log_fields)
 
-async def read_device_configuration(args):
-    device = await get_device(args)
-    if device != None:
-        async with BleakClient(device) as client:
-            async with NotifyWrapper(client) as wrapper:
-                success = False
-                while not success:
-                    await send_request(client, 2)
-                    try:
-                        count = 0
-                        while count < 4 and not success:
-                            async with asyncio.timeout(10):
-                                message = await wrapper.read()
-                            while len(message) > 4 and not success:
-                                # dump_message(message)
-                                magic, device_address, message_id = struct.unpack_from(">HBB", message, 0)
-                                if magic == 0xB55B and len(message) >= message_size[message_id]:
-                                    if message_id == 2:
-                                        (magic, device_address, message_id, backlight_mode, full_battery_voltage, low_voltage_alarm, high_voltage_alarm, over_current_alarm, rated_capacity, u1, u2, under_battery_voltage, u3, crc) = struct.unpack_from(">HBBBHHHHHBBHBB", message, 0)
-                                        if calc_crc(message[0:message_size[message_id]-1]) == crc:
-                                            success = True
-                                            if not args.json and not args.xml:
-                                                backlight_mode = "%i (%s)" % (backlight_mode, backlight_modes[backlight_mode])
-                                            else:
-                                                backlight_mode = str(backlight_mode)
-                                            info = {
-                                                "device_address":device_address,
-                                                "backlight_mode":backlight_mode,
-                                                "full_battery_voltage":full_battery_voltage/10,
-                                                "low_voltage_alarm":low_voltage_alarm/10,
-                                                "high_voltage_alarm":high_voltage_alarm/10,
-                                                "over_current_alarm":over_current_alarm/10,
-                                                "rated_capacity":rated_capacity/10,
-                                                "under_battery_voltage":under_battery_voltage/10,
-                                                "u1":u1,
-                                                "u2":u2,
-                                                "u3":u3
-                                            }
-                                            if args.json:
-                                                output_json(info)
-                                            elif args.xml:
-                                                output_xml("info", info)
-                                            else:
-                                                output_text(info)
-                                    message = message[message_size[message_id]:]
-                                else:
-                                    message = message[1:]
-                            count += 1
-                    except TimeoutError:
-                        # no response
-                        pass
+def read_device_list(filename):
+    # one device per line, everything after a # is a comment
+    devices = []
+    with open(filename) as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if len(line) > 0:
+                devices.append(line)
+    return devices
 
-async def set_byte(client : BleakClient, msg : int, value):
-    data = struct.pack(">HBBBBH", 0xA55A, 0, msg, value, 0, 0)
-    data += bytes([calc_crc(data)])
-    await client.write_gatt_char(uart_write_uuid, data, response=False)
+# The devices given on the command line and in the devices file, without duplicates.
+def device_addresses(args):
+    addresses = list(args.devices)
+    if args.devices_file != None:
+        addresses += read_device_list(args.devices_file)
+    expanded = []
+    for address in addresses:
+        if simulation.is_simulated(address):
+            expanded += simulation.expand_address(address)
+        else:
+            expanded.append(address)
+    return list(dict.fromkeys(expanded))
 
-async def set_short(client : BleakClient, msg : int, value):
-    data = struct.pack(">HBBHH", 0xA55A, 0, msg, value, 0)
-    data += bytes([calc_crc(data)])
-    await client.write_gatt_char(uart_write_uuid, data, response=False)
+async def log_many_devices(args):
+    addresses = device_addresses(args)
+    if len(addresses) == 0:
+        print ("no devices given!")
+        return
 
-async def set_short_float(client : BleakClient, msg : int, value):
-    await set_short(client, msg, round(value * 10.0))
+    async with ConnectionPool(args.max_connects, cache=open_cache(args), **buffer_options(args)) as pool:
+        connections = [pool.get(address) for address in addresses]
+        await log_connections(args, connections, ["address"] + log_fields)
 
-async def set_byte_float(client : BleakClient, msg : int, value):
-    await set_byte(client, msg, round(value * 10.0))
+async def read_device_configuration(args):
+    cache = open_cache(args)
+    connection = await open_device_connection(args, cache)
+    if connection != None:
+        async with connection:
+            info = None
+            while info == None:
+                try:
+                    info = await request_configuration(connection)
+                except TimeoutError:
+                    # no response
+                    pass
+                except ConnectFailed:
+                    print ("device not found!")
+                    return
+            output_config(args, info)
 
-async def set_name(client : BleakClient, msg : int, name):
-    buffer = bytearray(name, "utf-8") + bytearray([0] * 16)
-    data = struct.pack(">HBB", 0xA55A, 0, msg) + buffer[0:16]
-    await client.write_gatt_char(uart_write_uuid, data, response=False)
+def output_config(args, info):
+    backlight_mode = info["backlight_mode"]
+    if not args.json and not args.xml:
+        info["backlight_mode"] = "%i (%s)" % (backlight_mode, backlight_modes[backlight_mode])
+    else:
+        info["backlight_mode"] = str(backlight_mode)
+    if args.json:
+        output_json(info)
+    elif args.xml:
+        output_xml("info", info)
+    else:
+        output_text(info)
 
-config_funcs = {
-    "calibrating_current":(0x04, set_short_float),
-    "calibrating_voltage":(0x05, set_short_float),
-    "full_battery_voltage":(0x06, set_short_float),
-    "low_voltage_alarm":(0x07, set_short_float),
-    "high_voltage_alarm":(0x08, set_short_float),
-    "over_current_alarm":(0x09, set_short_float),
-    "rated_capacity":(0x0A, set_short_float),
-    "percentage":(0x0B, set_byte),
-    "device_address":(0x0C, set_byte),
-    "backlight_mode":(0x0d, set_byte),
-    "under_battery_voltage":(0x0E, set_short_float),
-    "device_name":(0x10, set_name)
-}
+async def send_setting(client : BleakClient, codec, value):
+    await client.write_gatt_char(uart_write_uuid, codec.encode(0, value), response=False)
+
+def parse_config_value(variable, text):
+    name, format, scale, index, shifts = config_messages[variable].fields[0]
+    if scale != 1:
+        return float(text)
+    elif format[-1] != "s":
+        return int(text)
+    else:
+        return text
 
 async def set_device_config(args):
     try:
-        cmd, func = config_funcs[args.variable]
+        value = parse_config_value(args.variable, args.value)
     except KeyError:
         print ("unknown value %s" % args.variable)
-        print ("known options: %s" % ",".join(config_funcs.keys()))
+        print ("known options: %s" % ",".join(config_messages.keys()))
+        return
+
+    cache = open_cache(args)
+    connection = await open_device_connection(args, cache)
+    if connection != None:
+        async with connection:
+            success = False
+            while not success:
+                try:
+                    await write_configuration(connection, args.variable, value)
+                    success = True
+                except TimeoutError:
+                    # no response
+                    pass
+                except ConnectFailed:
+                    print ("device not found!")
+                    return
+            print ("success")
+
+def serve(args):
+    import server
+    asyncio.run(server.serve(args))
+
+def rollout(args):
+    import rollout
+    asyncio.run(rollout.rollout(args))
+
+def energy_report(args):
+    from energy import EnergyAccount
+    account = EnergyAccount(args.state)
+    period = "months" if args.month else "days"
+    report = account.report(period, args.device, args.date)
+    if args.json:
+        print (json.dumps(report))
         return
+    print ("%-20s %-10s %14s %14s %14s %8s %6s" % ("device", period[:-1], "charge", "discharge", "V*I Wh", "samples", "resets"))
+    for address, entries in report.items():
+        for key, totals in sorted(entries.items()):
+            print ("%-20s %-10s %14i %14i %14.1f %8i %6i" % (address, key, totals["charge_energy"], totals["discharge_energy"], totals["integrated_wh"], totals["samples"], totals["resets"]))
 
-    if func == set_short_float or func == set_byte_float:
-        value = float(args.value)
-    elif func != set_name:
-        value = int(args.value)
+def profile_trace(args):
+    records = tracing.read_trace(args.trace)
+    if args.phase != None:
+        records = [record for record in records if record["phase"] == args.phase]
+    summary = tracing.summarize(records, args.by_device)
+    if args.json:
+        print (json.dumps([dict(address=key[0], phase=key[1], **summary[key]) for key in sorted(summary, key=tracing.summary_key)]))
     else:
-        value = args.value
+        tracing.print_summary(summary)
 
-    device = await get_device(args)
-    if device != None:
-        async with BleakClient(device) as client:
-            async with NotifyWrapper(client) as wrapper:
-                success = False
-                while not success:
-                    await func(client, cmd, value)
-                    try:
-                        count = 0
-                        while count < 10 and not success:
-                            async with asyncio.timeout(10):
-                                message = await wrapper.read()
-                            while len(message) > 4 and not success:
-                                magic, _, message_id = struct.unpack_from(">HBB", message, 0)
-                                if magic == 0xB55B and len(message) >= message_size[message_id]:
-                                    size = message_size[message_id]
-                                    if message_id == cmd and message[size-1] == calc_crc(message[0:size-1]):
-                                        success = True
-                                    message = message[message_size[message_id]:]
-                                else:
-                                    message = message[1:]
-                        count += 1
-                    except TimeoutError:
-                        # no response
-                        pass
-                    if success:
-                        print ("success")
+def decode_capture(args):
+    import capture
+    decoded = capture.decode_capture(args.capture)
+    prefix = args.output if args.output != None else os.path.splitext(args.capture)[0]
+    for filename in capture.write_decoded(prefix, decoded, args.format):
+        print (filename)
+    print ("%i samples, %i configurations" % (len(decoded["info"]["offset"]), len(decoded["config"]["offset"])))
+
+# A profile maps configuration variables to values, as JSON or YAML (which requires PyYAML).
+def load_profile(filename):
+    with open(filename) as f:
+        if filename.endswith(".yaml") or filename.endswith(".yml"):
+            try:
+                import yaml
+            except ImportError:
+                raise RuntimeError("YAML profiles require the PyYAML module")
+            profile = yaml.safe_load(f)
+        else:
+            profile = json.load(f)
+    values = {}
+    for variable, value in profile.items():
+        if variable not in config_messages:
+            raise ValueError("unknown value %s, known options: %s" % (variable, ",".join(config_messages.keys())))
+        values[variable] = parse_config_value(variable, str(value))
+    return values
+
+# Send all values without waiting for the acknowledgements in between, then collect them by message id. Values that
+# weren't acknowledged in time are sent again. Returns the variables that were acknowledged.
+async def write_configuration_values(connection : DeviceConnection, values, retries=3, timeout=10, spacing=0.0):
+    loop = asyncio.get_running_loop()
+    pending = {}
+    for variable, value in values.items():
+        codec = config_messages[variable]
+        pending[codec.message_id] = (variable, codec, value)
+    acknowledged = set()
+    async with connection.lock:
+        for attempt in range(retries):
+            for variable, codec, value in pending.values():
+                await connection.send(send_setting, codec, value)
+                if spacing > 0:
+                    await asyncio.sleep(spacing)
+            deadline = loop.time() + timeout
+            while len(pending) > 0 and deadline > loop.time():
+                try:
+                    frame = await connection.receive(None, deadline - loop.time())
+                except TimeoutError:
+                    break
+                except ConnectionError:
+                    # send everything that's still missing again after reconnecting
+                    break
+                if frame.message_id in pending:
+                    acknowledged.add(pending.pop(frame.message_id)[0])
+            if len(pending) == 0:
+                break
+    return acknowledged
+
+def config_value_matches(variable, value, actual):
+    name, format, scale, index, shifts = config_messages[variable].fields[0]
+    if scale != 1:
+        return round(value * scale) == round(actual * scale)
+    return value == actual
+
+# Write a profile and read the configuration back once. Returns one entry per variable with the requested value,
+# whether it was acknowledged, the value read back and if that matches (None for values the configuration message
+# doesn't contain, like the calibration values).
+async def apply_profile(connection : DeviceConnection, values, retries=3, timeout=10, spacing=0.0):
+    acknowledged = await write_configuration_values(connection, values, retries, timeout, spacing)
+    config = None
+    for attempt in range(retries):
+        try:
+            config = await request_configuration(connection, timeout=timeout)
+            break
+        except TimeoutError:
+            # no response
+            pass
+    report = {}
+    for variable, value in values.items():
+        actual = config.get(variable) if config != None else None
+        report[variable] = {
+            "requested":value,
+            "acknowledged":variable in acknowledged,
+            "actual":actual,
+            "match":config_value_matches(variable, value, actual) if actual != None else None
+        }
+    return report
+
+def output_profile_report(report):
+    for variable, entry in report.items():
+        if not entry["acknowledged"]:
+            state = "not acknowledged"
+        elif entry["match"] == None:
+            state = "acknowledged"
+        elif entry["match"]:
+            state = "ok"
+        else:
+            state = "MISMATCH"
+        actual = entry["actual"] if entry["actual"] != None else "?"
+        print ("%s: %s -> %s (%s)" % (variable, entry["requested"], actual, state))
+
+async def apply_device_profile(args):
+    try:
+        values = load_profile(args.profile)
+    except (OSError, ValueError, RuntimeError) as e:
+        print (e)
+        return
+
+    cache = open_cache(args)
+    connection = await open_device_connection(args, cache)
+    if connection != None:
+        async with connection:
+            try:
+                report = await apply_profile(connection, values, args.retries, args.timeout, args.spacing)
+            except ConnectFailed:
+                print ("device not found!")
+                return
+            if args.json:
+                output_json(report)
+            else:
+                output_profile_report(report)
 
 def main():
+    from sinks import sink_types, parse_size
     parser = argparse.ArgumentParser(description='WLS-MVAxxx python client')
+    parser.add_argument('--stats', help='print a summary of the metrics (notifications, frames, errors, latencies) on exit', action='store_true')
+    parser.add_argument('--trace', help='append the time of every phase (scan, connect, write, reply, ...) per device to this JSON Lines file')
 
     subparsers = parser.add_subparsers(help='operation', dest='command', required=True)
 
@@ -380,6 +1265,60 @@ def main():
     else:
         device_parser_group.add_argument('--mac', help='device MAC')
     device_parser_group.add_argument('--name', help='device name')
+    device_parser.add_argument('--connect-attempts', help='give up after this many failed connects (default: 3, log keeps trying)', type=int, default=3)
+
+    cache_parser = argparse.ArgumentParser(add_help=False)
+    cache_parser.add_argument('--no-cache', help='always scan for the device', action='store_true')
+    cache_parser.add_argument('--cache-ttl', help='seconds before a cached device has to be found again', type=float, default=24*60*60)
+    cache_parser.add_argument('--cache-file', help='device cache file (default: %s)' % default_cache_file())
+
+    devices_parser = argparse.ArgumentParser(add_help=False)
+    devices_parser.add_argument('devices', nargs='*', help='device MAC (uuid on macOS), or sim:<name> for a simulated device (sim:0-99 for many)')
+    devices_parser.add_argument('--devices-file', help='file with one device MAC (uuid on macOS) per line')
+    devices_parser.add_argument('--max-connects', type=int, default=4, help='maximum number of devices connecting at the same time')
+
+    poll_parser = argparse.ArgumentParser(add_help=False)
+    poll_parser.add_argument('--rate', help='samples per second and device (default: as fast as the device answers)', type=float)
+    poll_parser.add_argument('--idle-rate', help='slow down to this many samples per second while the current doesn\'t change', type=float)
+    poll_parser.add_argument('--change-threshold', help='current change (A) that switches back to the full rate (default: 0.1)', type=float, default=0.1)
+    poll_parser.add_argument('--jitter', help='random variation of the poll interval, as a fraction (default: 0.1)', type=float, default=0.1)
+    poll_parser.add_argument('--notify-buffer', help='notifications buffered per device (default: 1024)', type=int, default=1024)
+    poll_parser.add_argument('--overflow', help='what to do when the notification buffer is full (default: drop-oldest)', choices=overflow_policies, default='drop-oldest')
+
+    store_parser = argparse.ArgumentParser(add_help=False)
+    store_parser.add_argument('--store', help='append the samples to column files in this directory instead of printing csv')
+    store_parser.add_argument('--format', help='output format (default: csv)', choices=sink_types.keys(), default='csv')
+    store_parser.add_argument('--output', help='write to this file instead of stdout')
+    store_parser.add_argument('--compress', help='compress the output file', choices=['gzip', 'zstd'])
+    store_parser.add_argument('--rotate-size', help='start a new output file after this many bytes (K, M and G suffixes are allowed)', type=parse_size)
+    store_parser.add_argument('--rotate-interval', help='start a new output file after this many seconds', type=float)
+    store_parser.add_argument('--buffer-size', help='bytes collected before writing (default: 64K)', type=parse_size, default=64*1024)
+    store_parser.add_argument('--flush-interval', help='seconds before collected samples are written or committed to the database (default: 1)', type=float, default=1.0)
+    store_parser.add_argument('--database', help='write the samples to an SQLite file (or sqlite:FILE), or to an InfluxDB line protocol URL (http://...), instead of printing csv')
+    store_parser.add_argument('--commit-size', help='with --database, samples written in one transaction or request (default: 1000)', type=int, default=1000)
+    store_parser.add_argument('--aggregate', help='write the min/max/mean and energy used over windows of this many seconds instead of every sample, can be given several times', type=float, action='append')
+    store_parser.add_argument('--raw-output', help='with --aggregate, also write every sample to this file')
+    store_parser.add_argument('--pipeline', help='format and write the output in a worker thread or process, so a slow output doesn\'t delay the devices', choices=['thread', 'process'])
+    store_parser.add_argument('--batch-size', help='with --pipeline, samples handed to the worker at once (default: 256)', type=int, default=256)
+
+    alert_parser = argparse.ArgumentParser(add_help=False)
+    alert_parser.add_argument('--rules', help='alert rules (JSON or YAML), default: the alarm thresholds configured on each device')
+    alert_parser.add_argument('--alert-exec', help='run this shell command for every alert, can be given several times', action='append')
+    alert_parser.add_argument('--alert-webhook', help='POST every alert as JSON to this URL, can be given several times', action='append')
+    alert_parser.add_argument('--alert-syslog', help='send alerts to syslog (default: /dev/log, or host[:port] for UDP)', nargs='?', const='/dev/log')
+
+    metrics_parser = argparse.ArgumentParser(add_help=False)
+    metrics_parser.add_argument('--metrics-port', help='answer Prometheus /metrics requests on this TCP port', type=int)
+    metrics_parser.add_argument('--metrics-host', help='address to listen on for /metrics (default: localhost)', default='localhost')
+
+    daemon_parser = argparse.ArgumentParser(add_help=False)
+    daemon_parser.add_argument('--daemon', help='ask the serve daemon listening on this socket if it is running (default: %s)' % default_socket_file(), default=default_socket_file())
+    daemon_parser.add_argument('--no-daemon', help='always ask the device directly', action='store_true')
+    daemon_parser.add_argument('--max-age', help='ask the device directly if the data of the daemon is older than this many seconds (default: %i for read, %i for configuration)' % (daemon_max_age["info"], daemon_max_age["config"]), type=float)
+
+    from energy import default_state_file
+    energy_parser = argparse.ArgumentParser(add_help=False)
+    energy_parser.add_argument('--energy', help='keep daily and monthly energy totals in this state file (default: %s)' % default_state_file(), nargs='?', const=default_state_file())
 
     output_parser = argparse.ArgumentParser(add_help=False)
     output_format_group = output_parser.add_mutually_exclusive_group()
@@ -387,29 +1326,89 @@ def main():
     output_format_group.add_argument('--xml', help='print xml', action='store_true')
     output_format_group.add_argument('--text', help='print text', action='store_true')
 
-    parser_list = subparsers.add_parser('list', help='list WLS-MVAxxx detectable through bluetooth', parents=[])
-    parser_list.set_defaults(func=lambda args: asyncio.run(list_devices()))
+    parser_list = subparsers.add_parser('list', help='list WLS-MVAxxx detectable through bluetooth', parents=[cache_parser])
+    parser_list.add_argument('--cached', help='only list the devices in the cache, without scanning', action='store_true')
+    parser_list.add_argument('--concurrency', type=int, default=4, help='maximum number of devices checked at the same time')
+    parser_list.add_argument('--timeout', type=float, default=30, help='seconds a device has to answer before it is skipped')
+    parser_list.add_argument('--timing', help='show how long each device took to answer', action='store_true')
+    parser_list.set_defaults(func=lambda args: asyncio.run(list_devices(args)))
 
-    parser_read = subparsers.add_parser('read', help='read data from the device', parents=[device_parser, output_parser])
-    parser_read.set_defaults(func=lambda args: asyncio.run(read_device(args)))
+    parser_read = subparsers.add_parser('read', help='read data from the device', parents=[device_parser, cache_parser, output_parser, daemon_parser])
+    parser_read.set_defaults(func=read)
 
-    parser_config = subparsers.add_parser('configuration', help='read the configuration from the device', parents=[device_parser, output_parser])
-    parser_config.set_defaults(func=lambda args: asyncio.run(read_device_configuration(args)))
+    parser_config = subparsers.add_parser('configuration', help='read the configuration from the device', parents=[device_parser, cache_parser, output_parser, daemon_parser])
+    parser_config.set_defaults(func=read_configuration)
 
-    parser_setconfig = subparsers.add_parser('set', help='set a configuration value on the device', parents=[device_parser])
+    parser_setconfig = subparsers.add_parser('set', help='set a configuration value on the device', parents=[device_parser, cache_parser])
     parser_setconfig.add_argument("variable")
     parser_setconfig.add_argument("value")
     parser_setconfig.set_defaults(func=lambda args: asyncio.run(set_device_config(args)))
 
-    parser_log = subparsers.add_parser('log', help='log data from the device to csv', parents=[device_parser])
+    parser_apply = subparsers.add_parser('apply', help='write a profile of configuration values (JSON or YAML) to the device', parents=[device_parser, cache_parser])
+    parser_apply.add_argument('profile', help='profile file')
+    parser_apply.add_argument('--retries', help='attempts for values that weren\'t acknowledged (default: 3)', type=int, default=3)
+    parser_apply.add_argument('--timeout', help='seconds to wait for the acknowledgements (default: 10)', type=float, default=10)
+    parser_apply.add_argument('--spacing', help='seconds between writes, for devices that drop commands sent too quickly (default: 0)', type=float, default=0.0)
+    parser_apply.add_argument('--json', help='print json', action='store_true')
+    parser_apply.set_defaults(func=lambda args: asyncio.run(apply_device_profile(args)))
+
+    parser_rollout = subparsers.add_parser('rollout', help='write a profile of configuration values to many devices', parents=[devices_parser, cache_parser])
+    parser_rollout.add_argument('--profile', help='profile file', required=True)
+    parser_rollout.add_argument('--workers', help='devices configured at the same time (default: 8)', type=int, default=8)
+    parser_rollout.add_argument('--timeout', help='seconds one attempt on a device may take (default: 60)', type=float, default=60)
+    parser_rollout.add_argument('--retries', help='attempts per device (default: 3)', type=int, default=3)
+    parser_rollout.add_argument('--journal', help='progress journal, devices it lists as done are skipped')
+    parser_rollout.set_defaults(func=rollout)
+
+    parser_log = subparsers.add_parser('log', help='log data from the device', parents=[device_parser, cache_parser, poll_parser, store_parser, alert_parser, metrics_parser, energy_parser])
     parser_log.set_defaults(func=lambda args: asyncio.run(log_device(args)))
 
+    parser_logmany = subparsers.add_parser('log-many', help='log data from several devices into one output', parents=[devices_parser, cache_parser, poll_parser, store_parser, alert_parser, metrics_parser, energy_parser])
+    parser_logmany.set_defaults(func=lambda args: asyncio.run(log_many_devices(args)))
+
+    parser_serve = subparsers.add_parser('serve', help='keep polling several devices and answer HTTP/JSON queries', parents=[devices_parser, cache_parser, poll_parser, alert_parser, energy_parser])
+    parser_serve.add_argument('--host', help='address to listen on (default: localhost)', default='localhost')
+    parser_serve.add_argument('--port', help='TCP port to listen on, 0 to disable (default: 8080)', type=int, default=8080)
+    parser_serve.add_argument('--socket', help='also listen on this Unix socket (default: %s), read and configuration use it when it\'s there' % default_socket_file(), nargs='?', const=default_socket_file())
+    parser_serve.add_argument('--config-interval', help='seconds between configuration reads (default: 60)', type=float, default=60)
+    parser_serve.set_defaults(func=serve)
+
+    parser_energy = subparsers.add_parser('energy', help='show the energy totals kept by log, log-many or serve with --energy')
+    parser_energy.add_argument('--state', help='energy state file (default: %s)' % default_state_file(), default=default_state_file())
+    parser_energy.add_argument('--month', help='monthly instead of daily totals', action='store_true')
+    parser_energy.add_argument('--date', help='only this day (YYYY-MM-DD) or month (YYYY-MM)')
+    parser_energy.add_argument('--device', help='only this device')
+    parser_energy.add_argument('--json', help='print json', action='store_true')
+    parser_energy.set_defaults(func=energy_report)
+
+    parser_profile = subparsers.add_parser('profile', help='summarize the phase latencies of a --trace file')
+    parser_profile.add_argument('trace', help='trace file')
+    parser_profile.add_argument('--by-device', help='one summary per device', action='store_true')
+    parser_profile.add_argument('--phase', help='only this phase (scan, connect, start_notify, write, first_notification or reply)')
+    parser_profile.add_argument('--json', help='print json', action='store_true')
+    parser_profile.set_defaults(func=profile_trace)
+
+    parser_decode = subparsers.add_parser('decode', help='decode a capture of raw or hex dumped notifications', parents=[])
+    parser_decode.add_argument('capture', help='capture file')
+    parser_decode.add_argument('--format', help='output format (default: csv)', choices=['csv', 'npz', 'parquet'], default='csv')
+    parser_decode.add_argument('--output', help='prefix of the output files (default: capture file name without extension)')
+    parser_decode.set_defaults(func=decode_capture)
+
     args = parser.parse_args()
     # print (args)
+    if args.trace != None:
+        tracing.start(args.trace)
     try:
         args.func(args)
     except AttributeError:
         pass
+    finally:
+        if args.trace != None:
+            tracing.stop()
+        if args.stats:
+            metrics.print_summary()
 
 if __name__ == "__main__":
+    # server.py and rollout.py import host, which has to be this module and not a second copy of it
+    sys.modules.setdefault("host", sys.modules[__name__])
     main()
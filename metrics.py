@@ -0,0 +1,173 @@
+# Counters and histograms for the host.
+
+# Metrics are registered once at import time and looked up per device with labels(), so counting in the notification
+# path is one attribute update. All metrics can be rendered in the Prometheus text format (serve answers /metrics,
+# log and log-many with --metrics-port) or as a short summary (--stats).
+
+import sys
+from bisect import bisect_left
+
+registry = []
+
+class _CounterValue:
+    __slots__ = ["value"]
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+class _HistogramValue:
+    __slots__ = ["buckets", "counts", "sum", "count"]
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # upper bound of the bucket the given fraction of all values falls into
+    def quantile(self, fraction):
+        if self.count == 0:
+            return None
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= fraction * self.count:
+                return bound
+        return float("inf")
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.values = {}
+        registry.append(self)
+
+    def labels(self, *values):
+        value = self.values.get(values)
+        if value == None:
+            value = self._new_value()
+            self.values[values] = value
+        return value
+
+    def _label_text(self, values, extra=""):
+        pairs = ["%s=\"%s\"" % (name, str(value).replace("\\", "\\\\").replace("\"", "\\\"")) for name, value in zip(self.label_names, values)]
+        if extra != "":
+            pairs.append(extra)
+        return "{%s}" % ",".join(pairs) if len(pairs) > 0 else ""
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.kind)]
+        for values, value in list(self.values.items()):
+            lines += self._render_value(values, value)
+        return lines
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_value(self):
+        return _CounterValue()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def total(self):
+        return sum([value.value for value in self.values.values()])
+
+    def _render_value(self, values, value):
+        return ["%s%s %s" % (self.name, self._label_text(values), value.value)]
+
+    def summary(self):
+        return "%s: %s" % (self.name, self.total())
+
+# Like a counter, but the value is set instead of counted.
+class Gauge(Counter):
+    kind = "gauge"
+
+    def summary(self):
+        return "%s: %s (max %s)" % (self.name, self.total(), max([value.value for value in self.values.values()], default=0))
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)):
+        self.buckets = list(buckets)
+        super().__init__(name, help, labels)
+
+    def _new_value(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _render_value(self, values, value):
+        lines = []
+        seen = 0
+        for bound, count in zip(self.buckets + ["+Inf"], value.counts):
+            seen += count
+            lines.append("%s_bucket%s %i" % (self.name, self._label_text(values, "le=\"%s\"" % bound), seen))
+        lines.append("%s_sum%s %s" % (self.name, self._label_text(values), value.sum))
+        lines.append("%s_count%s %i" % (self.name, self._label_text(values), value.count))
+        return lines
+
+    def summary(self):
+        total = _HistogramValue(self.buckets)
+        for value in self.values.values():
+            total.counts = [a + b for a, b in zip(total.counts, value.counts)]
+            total.sum += value.sum
+            total.count += value.count
+        if total.count == 0:
+            return "%s: none" % self.name
+        return "%s: %i, mean %.3f, p50 <= %s, p99 <= %s" % (self.name, total.count, total.sum / total.count, total.quantile(0.5), total.quantile(0.99))
+
+def render():
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+def print_summary(file=sys.stderr):
+    for metric in registry:
+        if len(metric.values) > 0:
+            print (metric.summary(), file=file)
+
+content_type = "text/plain; version=0.0.4"
+
+async def _handle_client(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(b"HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %i\r\nConnection: close\r\n\r\n" % (status.encode(), content_type.encode(), len(body)) + body)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+# A minimal HTTP server that only answers /metrics.
+async def serve_metrics(host, port):
+    import asyncio
+    server = await asyncio.start_server(_handle_client, host, port)
+    print ("metrics on http://%s:%i/metrics" % (host, port), file=sys.stderr)
+    return server
@@ -0,0 +1,136 @@
+# Runs a sink in a worker thread or process, so formatting and writing never hold up the event loop.
+
+# The event loop only collects the records into batches, which are handed to the worker through a bounded queue. A
+# batch is handed over when it's full or batch_interval seconds after its first record, whichever comes first. If the
+# worker falls so far behind that the queue is full, batches are dropped (and counted) instead of blocking the loop,
+# which would delay the notifications of every device. If the worker stops because of an error, the error is raised
+# from the next write or flush in the event loop.
+#
+# A worker process needs a sink factory that can be pickled, like functools.partial of a module level function.
+
+import sys
+import queue
+import signal
+import asyncio
+import threading
+
+import metrics
+
+pipeline_batches_total = metrics.Counter("wls_pipeline_batches_total", "batches handed to the output worker")
+pipeline_dropped_total = metrics.Counter("wls_pipeline_dropped_total", "records dropped because the output worker fell behind")
+
+pipeline_modes = ["thread", "process"]
+
+def _run_worker(open_sink, batches, flush_interval, ignore_interrupt=False):
+    if ignore_interrupt:
+        # the main process tells the worker when to stop, after handing over the last batch
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    with open_sink() as sink:
+        while True:
+            try:
+                batch = batches.get(timeout=flush_interval)
+            except queue.Empty:
+                sink.flush()
+                continue
+            if batch == None:
+                break
+            for record in batch:
+                sink.write(record)
+
+class PipelineSink:
+    def __init__(self, open_sink, mode="thread", batch_size=256, batch_interval=0.1, max_batches=64, flush_interval=1.0, close_timeout=10.0):
+        if mode not in pipeline_modes:
+            raise ValueError("unknown pipeline mode %s" % mode)
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.batch = []
+        self.timer = None
+        self.dropped = 0
+        self.close_timeout = close_timeout
+        self.error = None
+        self.reported = False
+        if mode == "thread":
+            self.batches = queue.Queue(max_batches)
+            self.worker = threading.Thread(target=self._run_thread, args=(open_sink, self.batches, flush_interval), daemon=True)
+        else:
+            import multiprocessing
+            self.batches = multiprocessing.Queue(max_batches)
+            self.worker = multiprocessing.Process(target=_run_worker, args=(open_sink, self.batches, flush_interval, True), daemon=True)
+        self.worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # A worker thread keeps its error for the event loop, a worker process prints its own traceback.
+    def _run_thread(self, *args):
+        try:
+            _run_worker(*args)
+        except Exception as e:
+            self.error = e
+
+    def _check_worker(self):
+        if self.error == None and not self.worker.is_alive():
+            self.error = RuntimeError("output worker stopped (exit code %s)" % getattr(self.worker, "exitcode", None))
+        if self.error != None:
+            self.reported = True
+            raise self.error
+
+    def write(self, record):
+        if self.error != None:
+            self._check_worker()
+        self.batch.append(record)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+        elif self.timer == None:
+            self.timer = asyncio.get_running_loop().call_later(self.batch_interval, self._flush_later)
+
+    # the error of a stopped worker is raised from the next write instead of the timer
+    def _flush_later(self):
+        self.timer = None
+        try:
+            self.flush()
+        except Exception:
+            pass
+
+    # Hands the current batch to the worker.
+    def flush(self):
+        if self.timer != None:
+            self.timer.cancel()
+            self.timer = None
+        if len(self.batch) == 0:
+            return
+        self._check_worker()
+        batch = self.batch
+        self.batch = []
+        try:
+            self.batches.put_nowait(batch)
+            pipeline_batches_total.inc()
+        except queue.Full:
+            if self.dropped == 0:
+                print ("output can't keep up, dropping samples", file=sys.stderr)
+            self.dropped += len(batch)
+            pipeline_dropped_total.inc(len(batch))
+
+    def close(self):
+        if self.timer != None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.worker.is_alive():
+            # nothing can be handed over any more
+            if not self.reported:
+                try:
+                    self._check_worker()
+                except Exception as e:
+                    print ("output worker stopped: %s" % e, file=sys.stderr)
+            return
+        self.flush()
+        # the last batches are waited for, unless the worker doesn't take any more
+        try:
+            self.batches.put(None, timeout=self.close_timeout)
+        except queue.Full:
+            print ("output worker doesn't finish, giving up on the last samples", file=sys.stderr)
+            return
+        self.worker.join()
@@ -0,0 +1,330 @@
+# Protocol helpers for the WLS-MVAxxx serial protocol that don't depend on a Bluetooth stack.
+
+# Messages from the host start with 0xA55A, messages from the device start with 0xB55B. Every message ends with a
+# checksum byte, which is 255 minus the sum of all previous bytes.
+
+import struct
+from collections import namedtuple
+
+HOST_MAGIC = 0xA55A
+DEVICE_MAGIC = 0xB55B
+
+_DEVICE_HEADER = struct.pack(">H", DEVICE_MAGIC)
+
+def calc_crc(message):
+    return (255 - sum(message)) & 0xFF
+
+# MicroPython (which runs the emulator) has no struct.Struct
+class _FormatStruct:
+    def __init__(self, format):
+        self.format = format
+        self.size = struct.calcsize(format)
+
+    def pack(self, *values):
+        return struct.pack(self.format, *values)
+
+    def unpack_from(self, data, offset=0):
+        return struct.unpack_from(self.format, data, offset)
+
+_Struct = getattr(struct, "Struct", _FormatStruct)
+
+_bits = {"B":8, "H":16, "I":32}
+
+# Layout of one message. Every message starts with the magic, the device address and the message id, and ends with a
+# checksum (except for setting the device name). fields lists what comes in between as (name, format[, scale]):
+#  - a value with a scale is a fixed point number, the message contains value * scale
+#  - a format with several values is one number split into big endian parts, like the 24 bit energy counters
+#  - fields without a name are padding
+# The struct is compiled once, and so are the functions that turn its values into a dict or a record (the device
+# address and the named fields, scaled and put together), so decoding a message doesn't parse any formats or loop over
+# the fields. decode returns a dict, for the one-shot commands that print or change it. decode_record is for the
+# loggers: it returns a Record, a namedtuple that also has the address and time of the sample, so no dict is built
+# per sample. Records can be indexed by field name like the dicts, so alerts, energy totals and sinks take either, and
+# as_dict() converts one where a dict is needed, like for JSON.
+class MessageCodec:
+    def __init__(self, message_id, name, fields, magic=DEVICE_MAGIC, checksum=True):
+        self.message_id = message_id
+        self.name = name
+        self.magic = magic
+        self.checksum = checksum
+        self.format = ">HBB" + "".join([field[1] for field in fields]) + ("B" if checksum else "")
+        self.struct = _Struct(self.format)
+        self.size = self.struct.size
+        # (name, format, scale, index of the first value, shifts of the parts of a split number)
+        self.fields = []
+        index = 3
+        for field in fields:
+            if field[0] == None:
+                continue
+            format = field[1]
+            scale = field[2] if len(field) > 2 else 1
+            if format[-1] == "s":
+                shifts = None
+                count = 1
+            else:
+                shifts = []
+                shift = 0
+                for part in reversed(format):
+                    shifts.insert(0, shift)
+                    shift += _bits[part]
+                count = len(format)
+                if count == 1:
+                    shifts = None
+            self.fields.append((field[0], format, scale, index, shifts))
+            index += count
+        self.names = [field[0] for field in self.fields]
+        self._compile()
+
+    def _values(self):
+        values = ["raw[1]"]
+        for name, format, scale, index, shifts in self.fields:
+            if shifts != None:
+                value = " + ".join(["(raw[%i] << %i)" % (index + i, shift) if shift != 0 else "raw[%i]" % (index + i) for i, shift in enumerate(shifts)])
+                value = "(%s)" % value
+            else:
+                value = "raw[%i]" % index
+            if scale != 1:
+                value = "%s / %s" % (value, scale)
+            values.append(value)
+        return values
+
+    def _compile(self):
+        names = ["device_address"] + self.names
+        source = "def decode(data, unpack_from=unpack_from):\n    raw = unpack_from(data, 0)\n    return {%s}\n" % ", ".join(["%r:%s" % (name, value) for name, value in zip(names, self._values())])
+        namespace = {"unpack_from":self.struct.unpack_from}
+        exec(source, namespace)
+        self.decode = namespace["decode"]
+
+    # Compiled on first use, the emulator only packs messages.
+    def decode_record(self, data, address=None, time=None):
+        self._compile_record()
+        return self.decode_record(data, address, time)
+
+    def _compile_record(self):
+        self.Record = type(self.name.capitalize(), (Record, namedtuple(self.name.capitalize(), ["device_address"] + self.names + ["address", "time"])), {"__slots__":(), "message_id":self.message_id})
+        source = "def decode_record(data, address=None, time=None, unpack_from=unpack_from, new=new, Record=Record):\n    raw = unpack_from(data, 0)\n    return new(Record, (%s, address, time))\n" % ", ".join(self._values())
+        namespace = {"unpack_from":self.struct.unpack_from, "new":tuple.__new__, "Record":self.Record}
+        exec(source, namespace)
+        self.decode_record = namespace["decode_record"]
+
+    # Raw values (as they are sent, without scaling) in the order of the fields.
+    def pack(self, device_address, *values):
+        raw = [self.magic, device_address, self.message_id]
+        for (name, format, scale, index, shifts), value in zip(self.fields, values):
+            if shifts != None:
+                for shift, part in zip(shifts, format):
+                    raw.append((value >> shift) & ((1 << _bits[part]) - 1))
+            else:
+                raw.append(value)
+        if self.checksum:
+            raw.append(0)
+            data = bytearray(self.struct.pack(*raw))
+            data[-1] = calc_crc(data[:-1])
+            return bytes(data)
+        return self.struct.pack(*raw)
+
+    # Values with scale applied, strings are sent as UTF-8.
+    def encode(self, device_address, *values):
+        raw = []
+        for (name, format, scale, index, shifts), value in zip(self.fields, values):
+            if format[-1] == "s":
+                value = value.encode("utf-8") if isinstance(value, str) else value
+            elif scale != 1:
+                value = round(value * scale)
+            raw.append(value)
+        return self.pack(device_address, *raw)
+
+# Base of the records of decode_record. A field can be read as record.voltage or, like from a dict, record["voltage"].
+class Record:
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return self._fields
+
+    def as_dict(self):
+        return dict(zip(self._fields, self))
+
+    # the record types are made at run time, so they are pickled (for --pipeline process) by message id
+    def __reduce__(self):
+        return (_make_record, (self.message_id, tuple(self)))
+
+def _make_record(message_id, values):
+    codec = device_message(message_id)
+    if not hasattr(codec, "Record"):
+        codec._compile_record()
+    return tuple.__new__(codec.Record, values)
+
+# Messages by id, from the device and from the host
+device_messages = {}
+host_messages = {}
+
+def register(registry, codec):
+    registry[codec.message_id] = codec
+    return codec
+
+info_message = register(device_messages, MessageCodec(0x01, "info", [
+    ("percentage", "B"),
+    ("capacity", "H", 10),
+    ("voltage", "H", 10),
+    ("current", "H", 10),
+    ("charge_energy", "BH"),
+    ("discharge_energy", "BH"),
+    ("temperature", "H", 10),
+    ("u1", "B"),
+]))
+
+config_message = register(device_messages, MessageCodec(0x02, "config", [
+    ("backlight_mode", "B"),
+    ("full_battery_voltage", "H", 10),
+    ("low_voltage_alarm", "H", 10),
+    ("high_voltage_alarm", "H", 10),
+    ("over_current_alarm", "H", 10),
+    ("rated_capacity", "H", 10),
+    ("u1", "B"),
+    ("u2", "B"),
+    ("under_battery_voltage", "H", 10),
+    ("u3", "B"),
+]))
+
+# the device acknowledges a configuration change with a message using the same id
+_ack_fields = [
+    ("value", "H"),
+    ("u1", "B"),
+    ("u2", "B"),
+]
+for message_id in range(0x04, 0x11):
+    register(device_messages, MessageCodec(message_id, "ack", _ack_fields))
+
+_other_acks = {}
+
+# The codec of a device message, with the acknowledgement layout for ids that have no codec of their own (like the
+# answer to the calibration request 3). These aren't registered, so the decoders still skip them.
+def device_message(message_id):
+    codec = device_messages.get(message_id)
+    if codec == None:
+        codec = _other_acks.get(message_id)
+        if codec == None:
+            codec = MessageCodec(message_id, "ack", _ack_fields)
+            _other_acks[message_id] = codec
+    return codec
+
+# requests for the main display data (1), the configuration (2) and calibration (3?)
+for message_id in range(0x01, 0x04):
+    register(host_messages, MessageCodec(message_id, "request", [(None, "xxxx")], magic=HOST_MAGIC))
+
+def _setting(message_id, name, format, scale=1):
+    padding = "x" * (4 - struct.calcsize(">" + format))
+    return register(host_messages, MessageCodec(message_id, name, [("value", format, scale), (None, padding)], magic=HOST_MAGIC))
+
+_setting(0x04, "calibrating_current", "H", 10)
+_setting(0x05, "calibrating_voltage", "H", 10)
+_setting(0x06, "full_battery_voltage", "H", 10)
+_setting(0x07, "low_voltage_alarm", "H", 10)
+_setting(0x08, "high_voltage_alarm", "H", 10)
+_setting(0x09, "over_current_alarm", "H", 10)
+_setting(0x0A, "rated_capacity", "H", 10)
+_setting(0x0B, "percentage", "B")
+_setting(0x0C, "device_address", "B")
+_setting(0x0D, "backlight_mode", "B")
+_setting(0x0E, "under_battery_voltage", "H", 10)
+register(host_messages, MessageCodec(0x10, "device_name", [("value", "16s")], magic=HOST_MAGIC, checksum=False))
+
+# The configuration messages by variable name
+config_messages = {codec.name:codec for codec in host_messages.values() if codec.name != "request"}
+
+message_size = {message_id:codec.size for message_id, codec in device_messages.items()}
+
+# A complete device message with a valid checksum. data contains the whole message including header and checksum.
+Frame = namedtuple("Frame", ["message_id", "device_address", "data"])
+
+def unpack_info(data):
+    return info_message.decode(data)
+
+def unpack_config(data):
+    return config_message.decode(data)
+
+# A sample of a device as a Record, with its address and time.
+def unpack_info_record(data, address, time):
+    return info_message.decode_record(data, address, time)
+
+# Streaming decoder for the notification stream of a device.
+# The CH9141 bridge forwards the serial data in arbitrary chunks, so a message can be split across notifications and
+# a notification can contain several messages or line noise. Chunks are appended to one buffer and scanned in place;
+# consumed bytes are only discarded once they make up the larger part of the buffer, so resyncing never copies the
+# remaining data for every skipped byte, and incomplete messages are kept until the rest arrives.
+class FrameDecoder:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offset = 0
+        self.frames = 0
+        self.skipped = 0
+        self.crc_errors = 0
+
+    def pending(self):
+        return len(self.buffer) - self.offset
+
+    def reset(self):
+        self.buffer.clear()
+        self.offset = 0
+
+    def _compact(self):
+        if self.offset == len(self.buffer):
+            self.buffer.clear()
+            self.offset = 0
+        elif self.offset > len(self.buffer) // 2:
+            del self.buffer[:self.offset]
+            self.offset = 0
+
+    def feed(self, data):
+        self._compact()
+        self.buffer += data
+        return self._decode()
+
+    def _decode(self):
+        buffer = self.buffer
+        while len(buffer) - self.offset >= 4:
+            start = buffer.find(_DEVICE_HEADER, self.offset)
+            if start < 0:
+                # keep the last byte, it might be the first half of the next header:
+                end = len(buffer) - 1
+                self.skipped += end - self.offset
+                self.offset = end
+                return
+            self.skipped += start - self.offset
+            self.offset = start
+            if len(buffer) - start < 4:
+                return
+            message_id = buffer[start + 3]
+            size = message_size.get(message_id)
+            if size == None:
+                # not a message we know about, so this can't have been a header:
+                self.skipped += 1
+                self.offset = start + 1
+                continue
+            end = start + size
+            if len(buffer) < end:
+                # wait for the rest of the message
+                return
+            with memoryview(buffer) as view:
+                valid = calc_crc(view[start:end-1]) == buffer[end-1]
+                if valid:
+                    data = bytes(view[start:end])
+            if not valid:
+                self.crc_errors += 1
+                self.skipped += 1
+                self.offset = start + 1
+                continue
+            self.offset = end
+            self.frames += 1
+            yield Frame(message_id, buffer[start + 2], data)
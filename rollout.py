@@ -0,0 +1,132 @@
+# Rolls one configuration profile out to many devices.
+
+# A bounded number of devices is configured at the same time, each one with its own deadline and retries, so a device
+# that doesn't answer only holds up its own worker. Devices whose configuration already matches the profile are
+# skipped. Every finished device is appended to a journal (JSON lines), and devices the journal lists as done for the
+# same profile are skipped when the rollout is started again.
+
+import sys
+import json
+import time
+import asyncio
+import hashlib
+
+import host
+
+def profile_hash(values):
+    return hashlib.sha256(json.dumps(values, sort_keys=True).encode()).hexdigest()[:16]
+
+# Returns the addresses the journal lists as finished for the given profile.
+def read_journal(filename, profile):
+    finished = set()
+    try:
+        with open(filename) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line might be incomplete if the rollout was killed while writing it
+                    continue
+                if entry.get("profile") == profile and entry.get("status") in ("done", "skipped"):
+                    finished.add(entry["address"].upper())
+    except FileNotFoundError:
+        pass
+    return finished
+
+class Journal:
+    def __init__(self, filename, profile):
+        self.file = open(filename, "a") if filename != None else None
+        self.profile = profile
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.file != None:
+            self.file.close()
+
+    def write(self, address, status, attempts, report=None, error=None):
+        if self.file != None:
+            entry = {
+                "address":address,
+                "profile":self.profile,
+                "status":status,
+                "time":time.time(),
+                "attempts":attempts,
+                "report":report,
+                "error":error
+            }
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+
+# True if every value of the profile can be read back from the configuration and already has the requested value.
+def configuration_matches(config, values):
+    for variable, value in values.items():
+        actual = config.get(variable)
+        if actual == None or not host.config_value_matches(variable, value, actual):
+            return False
+    return True
+
+def report_ok(report):
+    return all([entry["acknowledged"] and entry["match"] != False for entry in report.values()])
+
+async def configure_device(connection, values, timeout):
+    async with asyncio.timeout(timeout):
+        config = await host.request_configuration(connection)
+        if configuration_matches(config, values):
+            return "skipped", None
+        report = await host.apply_profile(connection, values)
+        return ("done" if report_ok(report) else "failed"), report
+
+async def rollout_device(address, pool, workers, values, journal, args):
+    async with workers:
+        connection = pool.get(address)
+        start = time.perf_counter()
+        status, report, error = "failed", None, None
+        attempt = 0
+        try:
+            while attempt < args.retries:
+                attempt += 1
+                try:
+                    status, report = await configure_device(connection, values, args.timeout)
+                    error = None
+                    if status != "failed":
+                        break
+                except TimeoutError:
+                    status, error = "failed", "timeout"
+                # the connection is in an unknown state after a timeout, start over
+                await connection.close()
+                if attempt < args.retries:
+                    await asyncio.sleep(min(2 ** attempt, 30))
+        finally:
+            # hundreds of devices, so don't keep the connection around
+            await connection.close()
+        journal.write(address, status, attempt, report, error)
+        print ("%s: %s%s (%i attempts, %.1fs)" % (address, status, " - " + error if error != None else "", attempt, time.perf_counter() - start))
+        return status
+
+async def rollout(args):
+    try:
+        values = host.load_profile(args.profile)
+    except (OSError, ValueError, RuntimeError) as e:
+        print (e)
+        return
+    addresses = host.device_addresses(args)
+
+    profile = profile_hash(values)
+    if args.journal != None:
+        finished = read_journal(args.journal, profile)
+        remaining = [address for address in addresses if address.upper() not in finished]
+        if len(remaining) < len(addresses):
+            print ("%i devices already done according to the journal" % (len(addresses) - len(remaining)), file=sys.stderr)
+        addresses = remaining
+    if len(addresses) == 0:
+        print ("no devices left to configure")
+        return
+
+    workers = asyncio.Semaphore(args.workers)
+    with Journal(args.journal, profile) as journal:
+        async with host.ConnectionPool(args.max_connects, cache=host.open_cache(args)) as pool:
+            results = await asyncio.gather(*[rollout_device(address, pool, workers, values, journal, args) for address in addresses])
+    counts = {status:results.count(status) for status in ("done", "skipped", "failed")}
+    print ("%i done, %i skipped, %i failed" % (counts["done"], counts["skipped"], counts["failed"]))
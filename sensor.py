@@ -7,6 +7,7 @@
 # explanations, you already need to know a lot about BLE before you can use aioble...)
 
 import sys
+import time
 
 # ruff: noqa: E402
 sys.path.append("")
@@ -19,6 +20,8 @@ import aioble
 import bluetooth
 import struct
 
+from emulator import Emulator
+
 _ENV_DEVICE_INFO_UUID = bluetooth.UUID(0x180a)
 _ENV_UART_UUID = bluetooth.UUID(0xFFF0)
 _ENV_UART2_UUID = bluetooth.UUID(0xFFE0)
@@ -66,26 +69,15 @@ uart2_write_characteristic = aioble.Characteristic(uart2_service, _ENV_BLE_DATA2
 
 aioble.register_services(device_info_service, uart_service, uart2_service)
 
-messages = []
-
-device_name = "esp32-energy" # TODO: Different simulation modes based on name, for example different charge/discharge curves and voltage levels.
-
-percentage = 90
-backlight_mode = 0 # NO, NC, AUTO = normally on, normally off, auto
-full_battery_voltage = 20
-low_voltage_alarm = 100
-high_voltage_alarm = 300
-over_current_alarm = 40
-rated_capacity = 50 
-under_battery_voltage = 50
-device_address = 4
-
-voltage = 720
-capacity = 3000
-temperature = 220
-charge_energy = 2000
-discharge_energy = 2000
-current = 100
+device_name = "esp32-energy"
+# The simulation mode, see emulator.py. None takes it from the device name, so it can also be changed by renaming the
+# device from the host.
+simulation_mode = None
+# How often the display data is sent, the time between notifications in ms.
+notify_interval_ms = 200
+# Splits every message into notifications of at most this many bytes (0 to send each message in one), to test how the
+# host puts them back together.
+fragment_size = 0
 
 def set_backlight(mode : int):
     # My ESP32-WROOM board has a LED connector on pin 2:
@@ -95,104 +87,34 @@ def set_backlight(mode : int):
     else:
         p.off()
 
-def calc_crc(data : bytes) -> int:
-    crc = 255
-    for x in data:
-        crc -= x
-    return crc & 0xFF
+# The protocol itself lives in emulator.py, copy it to the board as well.
+emulator = Emulator(device_name, mode=simulation_mode)
+emulator.on_backlight = set_backlight
 
 async def sensor_task():
+    last = time.ticks_ms()
     while True:
-        if len(messages) > 0:
-            message = messages.pop(0)
+        now = time.ticks_ms()
+        emulator.step(time.ticks_diff(now, last) / 1000)
+        last = now
+
+        data = emulator.next_frame()
+        if fragment_size > 0:
+            for offset in range(0, len(data), fragment_size):
+                uart_data_characteristic.write(data[offset:offset+fragment_size], send_update=True)
+                await asyncio.sleep_ms(10)
         else:
-            message = 0x01
-        if message == 0x01:
-            # main display data:
-            data = struct.pack(">HBBBHHHBHBHHB", 0xB55B, device_address, 0x01, percentage, capacity, voltage, current, charge_energy >> 16, charge_energy & 0xFFFF, discharge_energy >> 16, discharge_energy & 0xFFFF, temperature,33)
-        elif message == 0x02:
-            # config data:
-            data = struct.pack(">HBBBHHHHHBBHB", 0xB55B, device_address, 0x02, backlight_mode, full_battery_voltage, low_voltage_alarm, high_voltage_alarm, over_current_alarm, rated_capacity, 5, 3, under_battery_voltage, 2)
-        else:
-            # set config:
-            # B55B010A000000A83C
-            data = struct.pack(">HBBHBB", 0xB55B, device_address, message, 0, 0, 0xA8) # sometimes 0xE8
-
-        if data != None:
-            data += bytes([calc_crc(data)])
             uart_data_characteristic.write(data, send_update=True)
 
-            print ("".join(["%2.2x" % x for x in data]))
-
-        await asyncio.sleep_ms(200)
-
-def handle_message(data : bytes):
-    global full_battery_voltage, percentage, backlight_mode, full_battery_voltage, low_voltage_alarm, high_voltage_alarm, over_current_alarm, rated_capacity, under_battery_voltage, device_address
-    global voltage, capacity, temperature, charge_energy, discharge_energy, current, device_name
-    
-    if data != None and len(data) >= 5:
-        crc = calc_crc(data[0:len(data)-1])
-        magic,_,cmd = struct.unpack_from(">HBB", data, 0)
-        buf_crc, = struct.unpack_from(">B", data, len(data)-1)
-        if magic == 0xA55A and crc == buf_crc:
-            # a55a000100000000ff -> sent on main screen
-            # a55a000200000000fe -> sent on setup screen
-            # a55a000300000000fd -> sent for callibration?
-            if cmd >= 4:
-                messages.extend([cmd, 2])
-            else: 
-                messages.append(cmd)
-            short_val = struct.unpack_from(">H", data, 4)[0]
-            byte_val = struct.unpack_from(">B", data, 4)[0]
-            if cmd == 0x04:
-                calibrating_current = short_val
-                print ("calibrating current: %i" % calibrating_current)
-            elif cmd == 0x05:
-                calibrating_voltage = short_val
-                print ("calibrating voltage: %i" % calibrating_voltage)
-            elif cmd == 0x06:
-                full_battery_voltage = short_val
-                print("full battery voltage: %i" % full_battery_voltage)
-            elif cmd == 0x07:
-                low_voltage_alarm = short_val
-                print ("low voltage alarm: %i" % low_voltage_alarm)
-            elif cmd == 0x08:
-                high_voltage_alarm = short_val
-                print ("high voltage alarm: %i" % high_voltage_alarm)
-            elif cmd == 0x09:
-                over_current_alarm = short_val
-                print ("over current alarm: %i" % over_current_alarm)
-            elif cmd == 0x0A:
-                rated_capacity = short_val
-                print ("rated capacity: %i" % rated_capacity)
-            elif cmd == 0x0B:
-                percentage = byte_val
-                print ("percentage: %i" % percentage)
-            elif cmd == 0x0C:
-                device_address = byte_val
-                print ("device address: %i" % device_address)
-            elif cmd == 0x0D:
-                backlight_mode = byte_val
-                print ("back light mode: %i" % backlight_mode)
-                set_backlight(backlight_mode)
-            elif cmd == 0x0E:
-                under_battery_voltage = short_val
-                print ("under battery voltage: %i" % under_battery_voltage)
-        elif magic == 0xA55A and cmd == 0x10:
-            messages.append(cmd)
-            l = 0
-            while data[4+l] != 0 and l < len(data) - 4:
-                l += 1
-            device_name = struct.unpack_from(">%is" % l, data, 4)[0]
-            print ("name: %s" % device_name)
-
         print ("".join(["%2.2x" % x for x in data]))
 
+        await asyncio.sleep_ms(notify_interval_ms)
+
 async def config_task():
     while True:
         await ble_data_characteristic.written()
         data = ble_data_characteristic.read()
-        handle_message(data)
+        emulator.handle_message(data)
         await asyncio.sleep_ms(500)
         
 async def uart_config_task():
@@ -209,13 +131,13 @@ async def peripheral_task():
     while True:
         async with await aioble.advertise(
             _ADV_INTERVAL_MS,
-            name=device_name,
+            name=emulator.device_name,
             # services=[_ENV_DEVICE_INFO_UUID, _ENV_UART_UUID, _ENV_UART2_UUID],
             appearance=_ADV_APPEARENCE_ENVIRONMENT_SENSOR,
             manufacturer=(0xca0c, bytes([0x31,0x00,0x00,0x00,0x00,0x00]))
         ) as connection:
             print("Connection from", connection.device)
-            messages.extend([1,2])
+            emulator.connected()
             await connection.disconnected(timeout_ms=None)
 
 # Run tasks.
@@ -226,5 +148,5 @@ async def main():
     t4 = asyncio.create_task(uart_config_task())
     await asyncio.gather(t1, t2, t3, t4)
 
-set_backlight(backlight_mode)
+set_backlight(emulator.backlight_mode)
 asyncio.run(main())
@@ -0,0 +1,216 @@
+# Local HTTP/JSON server for live readings.
+
+# The server keeps the connections to all devices open and polls them like log-many does. The latest sample and
+# configuration of every device are kept in memory, already serialized, so queries are answered without touching
+# the radio:
+#
+#   GET /devices                    all devices
+#   GET /devices/<address>          latest sample and configuration of a device
+#   GET /devices/<address>/info     latest sample
+#   GET /devices/<address>/config   latest configuration
+#   GET /stream[?device=<address>]  every new sample as JSON lines, until the client disconnects
+#   GET /metrics                    counters and histograms of the host in the Prometheus text format
+#
+# It listens on TCP (localhost by default) and/or a Unix socket.
+
+import os
+import sys
+import json
+import time
+import asyncio
+from urllib.parse import unquote, parse_qs
+
+import host
+import metrics
+
+_reasons = {
+    200:"OK",
+    404:"Not Found",
+    405:"Method Not Allowed",
+}
+
+# Keeps the latest data of one device up to date.
+class DeviceMonitor:
+    def __init__(self, connection, scheduler, config_interval, alerts=None):
+        self.connection = connection
+        self.alerts = alerts
+        self.scheduler = scheduler
+        self.config_interval = config_interval
+        self.info = None
+        self.config = None
+        self.updated = None
+        self.json = b""
+        self.info_json = b"null"
+        self.config_json = b"null"
+        self.update_json()
+
+    def update_json(self):
+        self.json = json.dumps(self.summary()).encode()
+
+    def summary(self):
+        return {
+            "address":self.connection.address,
+            "connected":self.connection.is_connected,
+            "updated":self.updated,
+            "info":self.info,
+            "config":self.config,
+        }
+
+    def set_info(self, info):
+        # the samples are records, the API returns them as objects
+        self.info = info.as_dict()
+        self.updated = info.time
+        self.info_json = json.dumps(self.info).encode()
+        self.update_json()
+
+    def set_config(self, config):
+        config["address"] = self.connection.address
+        config["time"] = time.time()
+        self.config = config
+        self.config_json = json.dumps(config).encode()
+        self.update_json()
+        if self.alerts != None:
+            self.alerts.set_config(self.connection.address, config)
+
+    async def poll_config(self):
+        while True:
+            try:
+                self.set_config(await host.request_configuration(self.connection))
+            except TimeoutError:
+                # no response
+                pass
+            await asyncio.sleep(self.config_interval)
+
+class Server:
+    def __init__(self, pool, addresses, new_scheduler, config_interval=60, alerts=None, energy=None):
+        self.alerts = alerts
+        self.energy = energy
+        self.monitors = {}
+        for address in addresses:
+            self.monitors[address.upper()] = DeviceMonitor(pool.get(address), new_scheduler(), config_interval, alerts)
+        self.subscribers = set()
+        self.dropped = 0
+
+    def publish(self, monitor, info):
+        if self.alerts != None:
+            self.alerts.check(info)
+        if self.energy != None:
+            self.energy.update(info)
+        monitor.set_info(info)
+        if len(self.subscribers) > 0:
+            line = monitor.info_json + b"\n"
+            for address, queue in self.subscribers:
+                if address == None or address == monitor.connection.address.upper():
+                    try:
+                        queue.put_nowait(line)
+                    except asyncio.QueueFull:
+                        # a slow client loses samples, it doesn't hold up the others
+                        self.dropped += 1
+
+    def tasks(self):
+        tasks = []
+        for monitor in self.monitors.values():
+            tasks.append(host.log_samples(monitor.connection, lambda info, monitor=monitor: self.publish(monitor, info), monitor.scheduler))
+            tasks.append(monitor.poll_config())
+        return [asyncio.create_task(task) for task in tasks]
+
+    def route(self, method, path):
+        if method != "GET":
+            return 405, b'{"error":"method not allowed"}'
+        parts = [unquote(part) for part in path.strip("/").split("/")]
+        if parts == ["devices"] or parts == [""]:
+            return 200, b"[" + b",".join([monitor.json for monitor in self.monitors.values()]) + b"]"
+        if len(parts) >= 2 and parts[0] == "devices":
+            monitor = self.monitors.get(parts[1].upper())
+            if monitor != None:
+                if len(parts) == 2:
+                    return 200, monitor.json
+                elif parts[2:] == ["info"]:
+                    return 200, monitor.info_json
+                elif parts[2:] == ["config"]:
+                    return 200, monitor.config_json
+        return 404, b'{"error":"not found"}'
+
+    async def stream(self, writer, query):
+        devices = parse_qs(query).get("device")
+        address = devices[0].upper() if devices != None else None
+        subscriber = (address, asyncio.Queue(1000))
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\n\r\n")
+        self.subscribers.add(subscriber)
+        try:
+            while True:
+                line = await subscriber[1].get()
+                writer.write(b"%x\r\n%s\r\n" % (len(line), line))
+                await writer.drain()
+        finally:
+            self.subscribers.discard(subscriber)
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if len(request_line) == 0:
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                if "content-length" in headers:
+                    await reader.readexactly(int(headers["content-length"]))
+                path, _, query = target.partition("?")
+                if method == "GET" and path.rstrip("/") == "/stream":
+                    await self.stream(writer, query)
+                    break
+                content_type = b"application/json"
+                if method == "GET" and path.rstrip("/") == "/metrics":
+                    status, body, content_type = 200, metrics.render().encode(), metrics.content_type.encode()
+                else:
+                    status, body = self.route(method, path)
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                writer.write(b"HTTP/1.1 %i %s\r\nContent-Type: %s\r\nContent-Length: %i\r\n%s\r\n" % (status, _reasons[status].encode(), content_type, len(body), b"" if keep_alive else b"Connection: close\r\n") + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+async def serve(args):
+    addresses = host.device_addresses(args)
+    if len(addresses) == 0:
+        print ("no devices given!")
+        return
+
+    async with host.ConnectionPool(args.max_connects, cache=host.open_cache(args), **host.buffer_options(args)) as pool:
+        alerts = host.open_alerts(args)
+        energy = host.open_energy(args)
+        server = Server(pool, addresses, host.scheduler_factory(args), args.config_interval, alerts, energy)
+        listeners = []
+        if args.port != 0:
+            listeners.append(await asyncio.start_server(server.handle_client, args.host, args.port))
+            print ("listening on http://%s:%i/" % (args.host, args.port), file=sys.stderr)
+        if args.socket != None:
+            if os.path.exists(args.socket):
+                os.unlink(args.socket)
+            listeners.append(await asyncio.start_unix_server(server.handle_client, args.socket))
+            print ("listening on %s" % args.socket, file=sys.stderr)
+        tasks = server.tasks()
+        if alerts != None:
+            alerts.start()
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            for listener in listeners:
+                listener.close()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if alerts != None:
+                await alerts.close()
+            if energy != None:
+                energy.save()
@@ -0,0 +1,168 @@
+# Simulated devices for the host, to test it without radios.
+
+# SimulatedClient stands in for a BleakClient: it runs the emulator from sensor.py in-process and delivers its
+# messages as notifications. Addresses of the form
+#
+#   sim:<name>[,rate=5][,fragment=8][,corrupt=0.01][,latency=0.05][,mode=cycle][,speed=60]
+#
+# select a simulated device: rate is the number of messages per second the device sends on its own (5 like the
+# emulator, 0 to only answer requests), fragment the largest chunk a message is split into, corrupt the probability
+# that a byte gets corrupted and latency the delay in seconds of every write and notification. mode is the simulation
+# mode of the emulator (by default from the name, "any" picks one per device) and speed how much faster than real time
+# the simulation runs, so a charge cycle or a day of solar can be watched in minutes.
+
+import random
+import asyncio
+
+from emulator import Emulator, modes, mode_for_name
+
+PREFIX = "sim:"
+
+def is_simulated(address):
+    return isinstance(address, str) and address.startswith(PREFIX)
+
+def parse_address(address):
+    parts = address[len(PREFIX):].split(",")
+    settings = {"name":parts[0], "rate":5.0, "fragment":0, "corrupt":0.0, "latency":0.0, "mode":"", "speed":1.0}
+    for part in parts[1:]:
+        key, _, value = part.partition("=")
+        if key not in settings or key == "name":
+            raise ValueError("unknown simulation setting %s" % key)
+        settings[key] = type(settings[key])(value)
+    if settings["mode"] not in modes and settings["mode"] not in ("", "any"):
+        raise ValueError("unknown simulation mode %s" % settings["mode"])
+    return settings
+
+# sim:0-999 is short for sim:0 ... sim:999, with the same settings for all of them
+def expand_address(address):
+    name, comma, settings = address[len(PREFIX):].partition(",")
+    first, dash, last = name.partition("-")
+    if dash == "" or not first.isdigit() or not last.isdigit():
+        return [address]
+    return ["%s%i%s%s" % (PREFIX, index, comma, settings) for index in range(int(first), int(last) + 1)]
+
+class SimulatedClient:
+    def __init__(self, address, disconnected_callback=None, seed=None, **kwargs):
+        settings = parse_address(address)
+        self.address = address
+        self.name = settings["name"]
+        self.rate = settings["rate"]
+        self.fragment = settings["fragment"]
+        self.corrupt = settings["corrupt"]
+        self.latency = settings["latency"]
+        self.speed = settings["speed"]
+        self.disconnected_callback = disconnected_callback
+        self.random = random.Random(seed if seed != None else address)
+        mode = settings["mode"]
+        if mode == "":
+            mode = mode_for_name(self.name)
+        elif mode == "any":
+            mode = self.random.choice(sorted(modes))
+        self.emulator = Emulator(self.name, log=None, mode=mode)
+        self.stepped = None
+        self.is_connected = False
+        self.callback = None
+        self.tasks = []
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.disconnect()
+
+    async def connect(self, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.is_connected = True
+        self.emulator.connected()
+        self.stepped = asyncio.get_running_loop().time()
+        self._start(self._sensor_task())
+
+    async def disconnect(self):
+        was_connected = self.is_connected
+        self.is_connected = False
+        for task in list(self.tasks):
+            task.cancel()
+        self.tasks.clear()
+        if was_connected and self.disconnected_callback != None:
+            self.disconnected_callback(self)
+        return True
+
+    async def start_notify(self, uuid, callback, **kwargs):
+        self._check_connected()
+        self.callback = callback
+
+    async def stop_notify(self, uuid):
+        self.callback = None
+
+    async def write_gatt_char(self, uuid, data, response=False):
+        self._check_connected()
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        self.emulator.handle_message(bytes(data))
+        if self.rate == 0:
+            # a device that only answers requests sends the answers right away, but like a real stack from the loop
+            # and not from within the write, or a poll loop would never give up the loop
+            self._start(self._answer())
+
+    def _start(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.append(task)
+        task.add_done_callback(self._finished)
+
+    def _finished(self, task):
+        if task in self.tasks:
+            self.tasks.remove(task)
+
+    def _check_connected(self):
+        if not self.is_connected:
+            from bleak.exc import BleakError
+            raise BleakError("not connected")
+
+    async def _answer(self):
+        while self.is_connected and len(self.emulator.messages) > 0:
+            await self._notify(self._next_frame())
+
+    # Same as sensor_task of the emulator, with a configurable rate.
+    async def _sensor_task(self):
+        if self.rate == 0:
+            return
+        # devices started together shouldn't all send at the same moment
+        await asyncio.sleep(self.random.uniform(0, 1.0 / self.rate))
+        while True:
+            await self._notify(self._next_frame())
+            await asyncio.sleep(1.0 / self.rate)
+
+    # The next message, with the simulation advanced to now.
+    def _next_frame(self):
+        now = asyncio.get_running_loop().time()
+        self.emulator.step((now - self.stepped) * self.speed)
+        self.stepped = now
+        return self.emulator.next_frame()
+
+    async def _notify(self, data):
+        if self.callback == None:
+            return
+        if self.corrupt > 0:
+            data = bytearray(data)
+            for i in range(len(data)):
+                if self.random.random() < self.corrupt:
+                    data[i] = self.random.randrange(256)
+        chunks = [data]
+        if self.fragment > 0:
+            chunks = []
+            offset = 0
+            while offset < len(data):
+                size = self.random.randint(1, self.fragment)
+                chunks.append(data[offset:offset+size])
+                offset += size
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        for chunk in chunks:
+            # like bleak, the callback can be a plain function or a coroutine, and every chunk is its own event
+            await asyncio.sleep(0)
+            if self.callback == None:
+                return
+            result = self.callback(None, bytearray(chunk))
+            if result != None:
+                await result
@@ -0,0 +1,226 @@
+# Output sinks for logged samples.
+
+# A sink formats records (the protocol.Record of a sample, or a dict) and collects the text in memory, it's only written when buffer_size characters are
+# waiting or flush_interval seconds have passed since the last write. Output goes to stdout or to a file, which can be
+# compressed and rotated by size or age, so a log can run for months without filling the disk with one huge file.
+
+import os
+import sys
+import time
+import json
+from operator import attrgetter, itemgetter
+
+# the same as xml.sax.saxutils.escape, which takes long to import
+def escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def format_csv_header(fields):
+    return ",".join(["\"%s\"" % field for field in fields])
+
+def format_csv(record, fields):
+    return format_csv_values([record[field] for field in fields])
+
+def format_csv_values(values):
+    return ",".join([str(value) for value in values])
+
+def format_json(record, fields):
+    return format_json_values(fields, [record[field] for field in fields])
+
+def format_json_values(fields, values):
+    return json.dumps(dict(zip(fields, values)))
+
+def format_xml(root, record, fields):
+    return format_xml_values(root, fields, [record[field] for field in fields])
+
+def format_xml_values(root, fields, values):
+    return "<%s>%s</%s>" % (root, "".join(["<%s>%s</%s>" % (field, escape(str(value)), field) for field, value in zip(fields, values)]), root)
+
+# Returns the values of fields of a record, by attribute for the namedtuple records of the loggers (which is faster
+# than by name) and by key for dicts.
+class FieldGetter:
+    def __init__(self, fields):
+        self.get_attributes = attrgetter(*fields)
+        self.get_items = itemgetter(*fields)
+        if len(fields) == 1:
+            # a single getter returns the value itself
+            self.get_attributes = lambda record, get=self.get_attributes: (get(record),)
+            self.get_items = lambda record, get=self.get_items: (get(record),)
+
+    def __call__(self, record):
+        if isinstance(record, tuple):
+            return self.get_attributes(record)
+        return self.get_items(record)
+
+_compression_extensions = {
+    None:"",
+    "gzip":".gz",
+    "zstd":".zst",
+}
+
+def _open_compressed(filename, compression):
+    if compression == "gzip":
+        import gzip
+        return gzip.open(filename, "at", encoding="utf-8", newline="")
+    elif compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("zstd compression requires the zstandard module")
+        import io
+        # closing the text wrapper also closes the compressor and the file
+        return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(open(filename, "ab")), encoding="utf-8", newline="")
+    return open(filename, "a", encoding="utf-8", newline="")
+
+# Where the text of a sink ends up. Without a filename this is stdout. With rotation, every file gets the time it was
+# started in its name (log-20240131-120000.csv.gz for log.csv), otherwise the file is appended to. rotate_size counts
+# the text before compression.
+class Output:
+    def __init__(self, filename=None, compression=None, rotate_size=None, rotate_interval=None):
+        if compression not in _compression_extensions:
+            raise ValueError("unknown compression %s" % compression)
+        self.filename = filename
+        self.compression = compression
+        self.rotate_size = rotate_size
+        self.rotate_interval = rotate_interval
+        self.file = None
+        self.written = 0
+        self.opened = 0
+
+    def current_filename(self, timestamped=False):
+        filename = self.filename
+        if timestamped or self.rotate_size != None or self.rotate_interval != None:
+            base, extension = os.path.splitext(filename)
+            filename = "%s-%s%s" % (base, time.strftime("%Y%m%d-%H%M%S"), extension)
+        extension = _compression_extensions[self.compression]
+        if not filename.endswith(extension):
+            filename += extension
+        return filename
+
+    # Returns True if a new file was started, so the sink has to write its header. Without append, an existing file
+    # isn't continued, a new one with the time in its name is started next to it.
+    def open(self, append=True):
+        if self.file != None:
+            return False
+        new = True
+        if self.filename == None:
+            self.file = sys.stdout
+        else:
+            filename = self.current_filename()
+            if not append and os.path.exists(filename) and os.path.getsize(filename) > 0:
+                filename = self.current_filename(True)
+            new = not os.path.exists(filename) or os.path.getsize(filename) == 0
+            self.file = _open_compressed(filename, self.compression)
+        self.written = 0
+        self.opened = time.monotonic()
+        return new
+
+    def needs_rotation(self):
+        if self.file == None or self.filename == None:
+            return False
+        if self.rotate_size != None and self.written >= self.rotate_size:
+            return True
+        if self.rotate_interval != None and time.monotonic() - self.opened >= self.rotate_interval:
+            return True
+        return False
+
+    def write(self, text):
+        self.file.write(text)
+        self.file.flush()
+        self.written += len(text)
+
+    def close(self):
+        if self.file != None and self.file is not sys.stdout:
+            self.file.close()
+        self.file = None
+
+class Sink:
+    header = None
+    footer = None
+
+    def __init__(self, fields, output=None, buffer_size=64*1024, flush_interval=1.0):
+        self.fields = fields
+        self.values = FieldGetter(fields)
+        self.output = output if output != None else Output()
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.lines = []
+        self.buffered = 0
+        self.flushed = time.monotonic()
+        # the header was written to the current file, so it needs the footer as well
+        self.started = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def format(self, record):
+        raise NotImplementedError()
+
+    def write(self, record):
+        line = self.format(record)
+        self.lines.append(line)
+        self.buffered += len(line) + 1
+        if self.buffered >= self.buffer_size or time.monotonic() - self.flushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.flushed = time.monotonic()
+        if len(self.lines) == 0:
+            return
+        if self.output.needs_rotation():
+            self._close_output()
+        # a document with a footer is complete once it was closed, nothing can be appended to it
+        if self.output.open(self.footer == None):
+            self.started = True
+            if self.header != None:
+                self.lines.insert(0, self.header)
+        self.lines.append("")
+        self.output.write("\n".join(self.lines))
+        self.lines.clear()
+        self.buffered = 0
+
+    def _close_output(self):
+        if self.output.file != None and self.footer != None and self.started:
+            self.output.write(self.footer + "\n")
+        self.output.close()
+        self.started = False
+
+    def close(self):
+        self.flush()
+        self._close_output()
+
+class CsvSink(Sink):
+    def __init__(self, fields, *args, **kwargs):
+        super().__init__(fields, *args, **kwargs)
+        self.header = format_csv_header(fields)
+
+    def format(self, record):
+        return format_csv_values(self.values(record))
+
+class JsonLinesSink(Sink):
+    def format(self, record):
+        return format_json_values(self.fields, self.values(record))
+
+# One document with a root element around all samples, written in pieces. A new document starts with every file.
+class XmlSink(Sink):
+    header = "<?xml version='1.0' encoding='utf-8'?>\n<samples>"
+    footer = "</samples>"
+
+    def format(self, record):
+        return format_xml_values("sample", self.fields, self.values(record))
+
+sink_types = {
+    "csv":CsvSink,
+    "jsonl":JsonLinesSink,
+    "xml":XmlSink,
+}
+
+# Accepts plain bytes or a K/M/G suffix
+def parse_size(text):
+    units = {"K":1024, "M":1024*1024, "G":1024*1024*1024}
+    text = text.strip().upper()
+    if len(text) > 0 and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
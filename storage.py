@@ -0,0 +1,170 @@
+# Columnar storage for logged samples.
+
+# Every column of the main display data is appended to its own file of fixed width values, one directory per device
+# and (UTC) day:
+#
+#   <root>/<device>/<YYYY-MM-DD>/time.f64
+#   <root>/<device>/<YYYY-MM-DD>/voltage.f32
+#   ...
+#
+# The values are stored little endian without any header, so a column can be memory mapped and used as an array
+# directly. Writing only needs the standard library, reading the columns back as arrays requires numpy.
+
+import os
+import sys
+import time
+import array
+import datetime
+
+# name, array typecode, file extension (= numpy dtype)
+columns = [
+    ("time", "d", "f64"),
+    ("percentage", "B", "u8"),
+    ("capacity", "f", "f32"),
+    ("voltage", "f", "f32"),
+    ("current", "f", "f32"),
+    ("charge_energy", "I", "u32"),
+    ("discharge_energy", "I", "u32"),
+    ("temperature", "f", "f32"),
+]
+
+_numpy_types = {
+    "f64":"<f8",
+    "f32":"<f4",
+    "u32":"<u4",
+    "u8":"u1",
+}
+
+def device_directory(address):
+    # MACs and uuids, but ':' isn't allowed in file names everywhere
+    return address.replace(":", "_")
+
+def day_directory(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime("%Y-%m-%d")
+
+def column_filename(directory, name, extension):
+    return os.path.join(directory, "%s.%s" % (name, extension))
+
+# Samples of one device and day that haven't been written yet.
+class _Chunk:
+    def __init__(self, directory):
+        self.directory = directory
+        self.arrays = [array.array(typecode) for name, typecode, extension in columns]
+        self.first = None
+
+    def append(self, timestamp, info):
+        if self.first == None:
+            self.first = time.monotonic()
+        for (name, typecode, extension), values in zip(columns, self.arrays):
+            values.append(timestamp if name == "time" else info[name])
+
+    def __len__(self):
+        return len(self.arrays[0])
+
+    def flush(self):
+        if len(self) == 0:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        for (name, typecode, extension), values in zip(columns, self.arrays):
+            if sys.byteorder == "big":
+                values.byteswap()
+            with open(column_filename(self.directory, name, extension), "ab") as f:
+                values.tofile(f)
+            del values[:]
+        self.first = None
+
+# Appends samples to the column files. Samples are collected in memory and written when flush_size samples of a
+# device and day are waiting or the oldest one has waited flush_interval seconds.
+class SampleStore:
+    def __init__(self, root, flush_size=256, flush_interval=10.0):
+        self.root = root
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.chunks = {}
+        self.checked = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def append(self, address, info, timestamp=None):
+        if timestamp == None:
+            timestamp = time.time()
+        key = (address, day_directory(timestamp))
+        chunk = self.chunks.get(key)
+        if chunk == None:
+            # a new day starts, so the previous chunk of the device won't get any more samples
+            for other in [other for other in self.chunks if other[0] == address]:
+                self.chunks.pop(other).flush()
+            chunk = _Chunk(os.path.join(self.root, device_directory(address), key[1]))
+            self.chunks[key] = chunk
+        chunk.append(timestamp, info)
+        now = time.monotonic()
+        if len(chunk) >= self.flush_size or now - chunk.first >= self.flush_interval:
+            chunk.flush()
+        # the samples of devices that stopped sending have to be written as well
+        if now - self.checked >= self.flush_interval:
+            self.checked = now
+            for chunk in self.chunks.values():
+                if chunk.first != None and now - chunk.first >= self.flush_interval:
+                    chunk.flush()
+
+    # Lets the store be used like one of the sinks, records need an address and a time
+    def write(self, record):
+        self.append(record["address"], record, record["time"])
+
+    def flush(self):
+        for chunk in self.chunks.values():
+            chunk.flush()
+
+    def close(self):
+        self.flush()
+        self.chunks.clear()
+
+def devices(root):
+    return sorted([name.replace("_", ":") for name in os.listdir(root) if os.path.isdir(os.path.join(root, name))])
+
+def _read_day(numpy, directory, start, end):
+    arrays = {}
+    for name, typecode, extension in columns:
+        filename = column_filename(directory, name, extension)
+        dtype = numpy.dtype(_numpy_types[extension])
+        if not os.path.exists(filename) or os.path.getsize(filename) < dtype.itemsize:
+            return None
+        arrays[name] = numpy.memmap(filename, dtype=dtype, mode="r")
+    # a column may be a few samples ahead if the writer was interrupted while flushing
+    count = min([len(values) for values in arrays.values()])
+    times = arrays["time"][:count]
+    first, last = numpy.searchsorted(times, [start, end], side="left")
+    return {name:values[first:last] for name, values in arrays.items()}
+
+# Returns a dict of numpy arrays, one for every column, with the samples of a device with start <= time < end.
+# Timestamps are seconds since the epoch, None means unbounded. Arrays of a single day are memory mapped views of the
+# files, longer ranges are concatenated.
+def read_samples(root, address, start=None, end=None):
+    import numpy
+
+    start = float("-inf") if start == None else start
+    end = float("inf") if end == None else end
+    directory = os.path.join(root, device_directory(address))
+    try:
+        days = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        days = []
+    first_day = day_directory(start) if start != float("-inf") else ""
+    last_day = day_directory(end) if end != float("inf") else "9999"
+    parts = []
+    for day in days:
+        if first_day <= day <= last_day:
+            part = _read_day(numpy, os.path.join(directory, day), start, end)
+            if part != None and len(part["time"]) > 0:
+                parts.append(part)
+    if len(parts) == 1:
+        return parts[0]
+    result = {}
+    for name, typecode, extension in columns:
+        dtype = numpy.dtype(_numpy_types[extension])
+        result[name] = numpy.concatenate([part[name] for part in parts]) if len(parts) > 0 else numpy.empty(0, dtype)
+    return result
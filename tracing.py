@@ -0,0 +1,95 @@
+# Latency tracing of the phases of talking to a device.
+
+# With host.py --trace FILE every phase of every device is written as one JSON line when it ends:
+#
+#   {"time": 1700000000.123, "address": "...", "phase": "connect", "seconds": 1.234, "status": "ok"}
+#
+# The phases are scan (finding a device that isn't cached), connect (including the service discovery bleak does
+# while connecting, and the scan it does itself when it only has the address), start_notify, write (sending a
+# request), first_notification (from the end of the write to the next notification of the device, which may also be
+# one it sent on its own) and reply (from the end of the write to the valid reply). status is "ok", "timeout" or the
+# error. python host.py profile FILE summarizes a trace with percentiles per phase, and per device with --by-device.
+#
+# Without --trace record() returns right away, so the phases can be traced unconditionally.
+
+import sys
+import json
+import time
+
+phases = ["scan", "connect", "start_notify", "write", "first_notification", "reply"]
+
+class Tracer:
+    def __init__(self, filename):
+        self.file = open(filename, "a")
+
+    def record(self, address, phase, seconds, status="ok"):
+        self.file.write(json.dumps({"time":time.time(), "address":address, "phase":phase, "seconds":round(seconds, 6), "status":status}) + "\n")
+
+    def close(self):
+        self.file.close()
+
+tracer = None
+
+def start(filename):
+    global tracer
+    tracer = Tracer(filename)
+
+def stop():
+    global tracer
+    if tracer != None:
+        tracer.close()
+        tracer = None
+
+def record(address, phase, seconds, status="ok"):
+    if tracer != None:
+        tracer.record(address, phase, seconds, status)
+
+def read_trace(filename):
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if len(line) > 0:
+                yield json.loads(line)
+
+# nearest rank percentile of sorted values
+def percentile(values, fraction):
+    return values[min(len(values) - 1, max(0, int(fraction * len(values) + 0.5) - 1))]
+
+# {(address or None, phase): {"count", "errors", "mean", "p50", "p90", "p99", "max"}} of the phases that finished, the
+# errors are counted separately.
+def summarize(records, by_device=False):
+    durations = {}
+    errors = {}
+    for record in records:
+        key = (record["address"] if by_device else None, record["phase"])
+        if record["status"] == "ok":
+            durations.setdefault(key, []).append(record["seconds"])
+        else:
+            errors[key] = errors.get(key, 0) + 1
+    summary = {}
+    for key in set(durations) | set(errors):
+        values = sorted(durations.get(key, []))
+        entry = {"count":len(values), "errors":errors.get(key, 0)}
+        if len(values) > 0:
+            entry["mean"] = sum(values) / len(values)
+            for name, fraction in [("p50", 0.5), ("p90", 0.9), ("p99", 0.99)]:
+                entry[name] = percentile(values, fraction)
+            entry["max"] = values[-1]
+        summary[key] = entry
+    return summary
+
+# sorts summary keys by device and then in the order the phases happen
+def summary_key(key):
+    address, phase = key
+    return (address or "", phases.index(phase) if phase in phases else len(phases), phase)
+
+def print_summary(summary, file=sys.stdout):
+    print ("%-24s %-18s %7s %6s %9s %9s %9s %9s %9s" % ("device", "phase", "count", "errors", "mean", "p50", "p90", "p99", "max"), file=file)
+    for key in sorted(summary, key=summary_key):
+        entry = summary[key]
+        address, phase = key
+        if entry["count"] > 0:
+            times = " ".join(["%9.3f" % entry[name] for name in ["mean", "p50", "p90", "p99", "max"]])
+        else:
+            times = " ".join(["%9s" % "-"] * 5)
+        print ("%-24s %-18s %7i %6i %s" % (address or "all", phase, entry["count"], entry["errors"], times), file=file)